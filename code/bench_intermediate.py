@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+import intermediate_io
+import quadkey_int
+from synthetic_data import synthetic_yearly_table
+
+# Benchmark of the yearly intermediate format: size, write time, full read time
+# and tile-range read time of the legacy gzip parquet against typed, sorted
+# parquet with several codecs and levels.
+
+FORMATS = [
+    ('legacy gzip', 'gzip', None, True),
+    ('typed gzip', 'gzip', None, False),
+    ('typed snappy', 'snappy', None, False),
+    ('typed lz4', 'lz4', None, False),
+    ('typed zstd-1', 'zstd', 1, False),
+    ('typed zstd-3', 'zstd', 3, False),
+    ('typed zstd-9', 'zstd', 9, False),
+]
+
+# Parser
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark intermediate parquet formats.')
+    parser.add_argument('--input', type=str, default=None, help='Yearly by_quadkey table to benchmark (default: synthetic)')
+    parser.add_argument('--rows', type=int, default=2_000_000, help='Rows of the synthetic table')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed repetitions (best is reported)')
+    parser.add_argument('--output_json', type=str, default=None, help='Write the results to this JSON file')
+    return parser.parse_args()
+
+# The yearly table in the layout read_and_group_ookla.py wrote before the typed format:
+# quadkey strings (in groupby order), float64 averages, int64 counts and population
+LEGACY_COLUMNS = ['quadkey', 'avg_d_kbps', 'avg_u_kbps', 'avg_lat_ms', 'tests', 'devices', 'pop_2020']
+LEGACY_DTYPES = {'avg_d_kbps': 'float64', 'avg_u_kbps': 'float64', 'avg_lat_ms': 'float64', 'tests': 'int64', 'devices': 'int64', 'pop_2020': 'float64'}
+
+def legacy_table(all_data):
+    all_data = all_data if 'quadkey' in all_data else all_data.assign(quadkey=quadkey_int.decode(all_data['quadkey_int']))
+    legacy = all_data[LEGACY_COLUMNS].astype(LEGACY_DTYPES)
+    return legacy.sort_values('quadkey').reset_index(drop=True)
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark(all_data, repeats):
+    # A tile range covering a small part of the map, as a country or region query would
+    query_keys = quadkey_int.parent(all_data['quadkey_int'].to_numpy()[:1], 5)
+    filters = intermediate_io.tile_range_filters(query_keys, int(quadkey_int.level_of(all_data['quadkey_int'].to_numpy()[:1])[0]))
+
+    legacy_data = legacy_table(all_data)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, compression, level, legacy in FORMATS:
+            path = os.path.join(tmp_dir, f'{name.replace(" ", "_")}.parquet')
+
+            if legacy:
+                write = lambda: legacy_data.to_parquet(path, index=False, compression=compression)
+            else:
+                write = lambda: intermediate_io.write_intermediate(all_data, path, compression, level)
+
+            write_s = best_time(write, repeats)
+            read_s = best_time(lambda: intermediate_io.read_intermediate(path), repeats)
+            range_s = None if legacy else best_time(lambda: intermediate_io.read_intermediate(path, filters=filters), repeats)
+
+            results.append({
+                'format': name,
+                'size_mb': round(os.path.getsize(path) / 1024 / 1024, 2),
+                'write_s': round(write_s, 3),
+                'read_s': round(read_s, 3),
+                'range_read_s': None if range_s is None else round(range_s, 3),
+            })
+    return results
+
+def main():
+    args = parse_args()
+
+    if args.input:
+        all_data = intermediate_io.read_intermediate(args.input, with_quadkey=True)
+    else:
+        all_data = synthetic_yearly_table(args.rows)
+
+    results = benchmark(all_data, args.repeats)
+
+    print(f'{len(all_data)} tiles')
+    print(pd.DataFrame(results).to_string(index=False))
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump({'rows': len(all_data), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
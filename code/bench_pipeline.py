@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import country_lookup
+import create_summary_file
+import instrumentation
+import read_and_group_ookla as rg
+from instrumentation import current_peak_rss_mb, peak_rss_mb, reset_peak_rss
+from synthetic_data import synthetic_countries, synthetic_population, write_synthetic_tiles
+
+# Benchmark of the aggregation and summary stages on synthetic Ookla-shaped data.
+#
+# Each stage (read, rollup, quarter combine, pop join, spatial join, country
+# groupby) is timed separately; wall time, rows in, throughput and the peak
+# RSS reached during the stage are written to a JSON results file. With
+# --baseline, stages that got slower than --tolerance are reported.
+
+# Parser
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the aggregation and summary stages.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Rows per synthetic quarterly tiles file')
+    parser.add_argument('--quarters', type=int, default=4, help='Number of quarterly files')
+    parser.add_argument('--zoom_level', type=int, default=13, help='Zoom level of the aggregation')
+    parser.add_argument('--data_dir', type=str, default=None, help='Keep the synthetic files here (default: temporary directory)')
+    parser.add_argument('--output_json', type=str, default='bench_pipeline_results.json', help='Results file')
+    parser.add_argument('--baseline', type=str, default=None, help='Previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown reported as a regression')
+    return parser.parse_args()
+
+class StageTimer:
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, rows_in, func, *args):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = func(*args)
+        wall_s = time.perf_counter() - start
+
+        self.stages.append({
+            'stage': name,
+            'wall_s': round(wall_s, 4),
+            'rows_in': int(rows_in),
+            'rows_per_s': round(rows_in / wall_s) if wall_s > 0 else None,
+            'peak_rss_mb': round(current_peak_rss_mb(), 1),
+        })
+        print(f'{name:<16} {wall_s:8.3f} s  {rows_in:>12,} rows')
+        return result
+
+def run_benchmark(args, data_dir):
+    timer = StageTimer()
+
+    # Synthetic inputs (not timed)
+    paths = [os.path.join(data_dir, f'bench-{q}_performance_fixed_tiles.parquet') for q in range(args.quarters)]
+    for q, path in enumerate(paths):
+        if not os.path.exists(path):
+            write_synthetic_tiles(path, args.rows, seed=q)
+    pop_data = synthetic_population(zoom_level=13)
+    pop_path = os.path.join(data_dir, 'bench_pop.parquet')
+    pop_data.to_parquet(pop_path, index=False)
+    gdf = synthetic_countries()
+
+    # Aggregation stages
+    sums_list = []
+    for path in paths:
+        tiles = timer.run('read', args.rows, pd.read_parquet, path)
+        sums_list.append(timer.run('rollup', len(tiles), rg.tile_sums, tiles, args.zoom_level))
+        del tiles
+
+    sums = timer.run('quarter_combine', sum(len(s) for s in sums_list), rg.combine_sums, sums_list)
+
+    pop_data = rg.population_at(rg.load_population(pop_path), args.zoom_level)
+    all_data = timer.run('pop_join', len(sums), lambda: rg.join_population(rg.sums_to_averages(sums), pop_data))
+
+    # Summary stages
+    keys = all_data['quadkey_int'].to_numpy(dtype=np.uint64)
+    lookup = timer.run('spatial_join', len(keys), lambda: country_lookup.update_lookup(country_lookup.load_lookup(''), keys, gdf)[0])
+    timer.run('country_groupby', len(all_data), create_summary_file.summarise_by_country, all_data, lookup, gdf, 0, 'fixed')
+
+    return timer.stages
+
+# Stages whose wall time grew by more than `tolerance` relative to the baseline
+def regressions(stages, baseline, tolerance):
+    base = {}
+    for stage in baseline['stages']:
+        base[stage['stage']] = base.get(stage['stage'], 0) + stage['wall_s']
+    current = {}
+    for stage in stages:
+        current[stage['stage']] = current.get(stage['stage'], 0) + stage['wall_s']
+    return {
+        name: {'baseline_s': round(base[name], 4), 'current_s': round(wall_s, 4)}
+        for name, wall_s in current.items()
+        if name in base and base[name] > 0 and wall_s > base[name] * (1 + tolerance)
+    }
+
+def main():
+    args = parse_args()
+    # The stages are timed here, keep the per-stage JSON lines of the pipeline code quiet
+    instrumentation.configure(enabled=False)
+
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        stages = run_benchmark(args, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            stages = run_benchmark(args, data_dir)
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'rows_per_quarter': args.rows,
+        'quarters': args.quarters,
+        'zoom_level': args.zoom_level,
+        'total_wall_s': round(sum(stage['wall_s'] for stage in stages), 4),
+        'peak_rss_mb': max([round(peak_rss_mb(), 1)] + [stage['peak_rss_mb'] for stage in stages]),
+        'stages': stages,
+    }
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = regressions(stages, json.load(f), args.tolerance)
+        for name, times in results['regressions'].items():
+            print(f'Regression in {name}: {times["baseline_s"]} s -> {times["current_s"]} s')
+
+    with open(args.output_json, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output_json}')
+
+if __name__ == '__main__':
+    main()
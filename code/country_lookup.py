@@ -0,0 +1,120 @@
+import glob
+import hashlib
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import quadkey_int
+
+# Persistent quadkey -> country lookup
+#
+# The point-in-polygon join only depends on the tile and on the country polygons,
+# so its result is stored on disk, keyed by zoom level and by a hash of the
+# shapefile, and reused across years, internet types and runs. Tiles that fall
+# in no country are stored too (with a null Country) so they are not re-joined.
+# For parallel summaries the lookup is also exported as two .npy arrays (sorted
+# keys and country codes) that worker processes memory-map instead of each
+# loading the lookup or the country polygons.
+
+LOOKUP_COLUMNS = ['Country', 'REGION_WB']
+
+
+# Hash of all the files that make up a shapefile (.shp, .dbf, .shx, .prj, ...)
+def shapefile_hash(shapefile_path):
+    stem = os.path.splitext(shapefile_path)[0]
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(f'{glob.escape(stem)}.*')):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def lookup_path(base_path, zoom_level, shp_hash):
+    return f'{base_path}/data/lookup/quadkey_country_{zoom_level}_{shp_hash}.parquet'
+
+
+def load_lookup(path):
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    return pd.DataFrame({
+        'quadkey_int': pd.Series(dtype='uint64'),
+        **{col: pd.Series(dtype='object') for col in LOOKUP_COLUMNS},
+    })
+
+
+def save_lookup(lookup, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lookup.to_parquet(path, index=False)
+
+
+# Position in gdf of the country containing each point (-1 when no polygon contains it)
+def assign_country(lat, lon, gdf):
+    points = gpd.points_from_xy(lon, lat, crs=4326)
+    point_idx, country_idx = gdf.sindex.query(points, predicate='within')
+
+    # Points on a boundary are never within a polygon; a point matches twice only where polygons overlap,
+    # and then the first polygon is kept
+    first = np.unique(point_idx, return_index=True)[1]
+    country_pos = np.full(len(points), -1, dtype=np.int64)
+    country_pos[point_idx[first]] = country_idx[first]
+    return country_pos
+
+
+# Add the tiles that are not in the lookup yet; returns the lookup and the number of new tiles
+def update_lookup(lookup, keys, gdf):
+    keys = np.unique(np.asarray(keys, dtype=np.uint64))
+    new_keys = keys[~np.isin(keys, lookup['quadkey_int'].to_numpy())]
+    if len(new_keys) == 0:
+        return lookup, 0
+
+    lat, lon = quadkey_int.to_geo(new_keys)
+    country_pos = assign_country(lat, lon, gdf)
+    matched = country_pos >= 0
+
+    new_rows = pd.DataFrame({'quadkey_int': new_keys})
+    for col in LOOKUP_COLUMNS:
+        values = np.full(len(new_keys), None, dtype=object)
+        values[matched] = gdf[col].to_numpy()[country_pos[matched]]
+        new_rows[col] = values
+
+    lookup = pd.concat([lookup, new_rows], ignore_index=True).sort_values('quadkey_int', ignore_index=True)
+    return lookup, len(new_keys)
+
+
+def lookup_array_paths(path):
+    stem = path[:-len('.parquet')]
+    return f'{stem}_keys.npy', f'{stem}_codes.npy'
+
+
+# Write the tiles that have a country as sorted keys and codes into the sorted country names;
+# returns the paths of the two arrays and the country names. Arrays older than the lookup are rewritten.
+def save_lookup_arrays(lookup, path):
+    known = lookup.dropna(subset=['Country']).sort_values('quadkey_int')
+    countries = np.sort(known['Country'].unique()).astype(object)
+    keys_path, codes_path = lookup_array_paths(path)
+
+    stale = [
+        not os.path.exists(array_path) or (os.path.exists(path) and os.path.getmtime(array_path) < os.path.getmtime(path))
+        for array_path in (keys_path, codes_path)
+    ]
+    if any(stale):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(keys_path, known['quadkey_int'].to_numpy(dtype=np.uint64))
+        np.save(codes_path, np.searchsorted(countries, known['Country'].to_numpy()).astype(np.int32))
+    return keys_path, codes_path, countries
+
+
+# Country code of each key (-1 when the key has no country), looked up in the memory-mapped arrays
+def lookup_codes(keys, keys_path, codes_path):
+    lookup_keys = np.load(keys_path, mmap_mode='r')
+    lookup_codes = np.load(codes_path, mmap_mode='r')
+    keys = np.asarray(keys, dtype=np.uint64)
+
+    if len(lookup_keys) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(lookup_keys, keys), len(lookup_keys) - 1)
+    return np.where(lookup_keys[pos] == keys, lookup_codes[pos], -1)
@@ -1,77 +1,329 @@
+import argparse
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import getpass
-from pyquadkey2.quadkey import QuadKey
-from shapely.geometry import Point
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-username = getpass.getuser()
-base_path = f'/home/{username}/GitHub/Pop-Weighted-Internet-Speed'
-
-# Read WB Boundaries
-gdf = gpd.read_file(f'{base_path}/raw_data/wb_countries/WB_countries_Admin0_10m.shp')
-gdf = gdf[['POP_EST', 'GDP_MD_EST', 'ISO_N3', 'WB_A3', 'REGION_WB', 'NAME_EN', 'geometry']]
-gdf = gdf.rename(columns={'NAME_EN': 'Country'})
-gdf['ISO_N3'] = gdf['ISO_N3'].astype(int)
-#   gdf['geometry'] = gdf['geometry'].translate(xoff=-0.000000000100041)  # Fix Rounding Issue in WB Boundaries Data
+import country_lookup
+import polygon_cover
+import instrumentation
+import intermediate_io
+import quadkey_int
+import summary_cube
+import weighted_agg
+import weighted_sketch
+from instrumentation import stage
 
+username = getpass.getuser()
+default_base_path = f'/home/{username}/GitHub/Pop-Weighted-Internet-Speed'
 
 #----------------------------------#
 # SET PARAMETERS
 
 zoom_level = 13
 years = [2019, 2020, 2021, 2022, 2023, 2024]
-types = ['mobile', 'fixed'] 
+types = ['mobile', 'fixed']
 
-#----------------------------------#
-# CALCULATE COUNTRY METRICS
-
-all_data = []
-
-for year in years:
-    for d_type in types:
-        # Read Internet Data
-        input_internet = f"{base_path}/data/internet_speed_{d_type}_{year}_by_quadkey_{zoom_level}.parquet.gz"
-        input_internet = pd.read_parquet(input_internet)
-
-        # Get Coordinates of Quadkey        
-        input_internet['coordinates'] = input_internet['quadkey'].apply(lambda qk: QuadKey(qk).to_geo())
-        input_internet['geometry'] = input_internet['coordinates'].apply(lambda x: Point(x[1], x[0]))
-
-        # Perform spatial join to find which country each point falls into
-        points = gpd.GeoDataFrame(input_internet, geometry='geometry', crs=4326)
-        result = gpd.sjoin(points, gdf, how='left', op='within').set_index('Country')
-
-        # Get Internet country avg weighted by Pop and weighted by tests
-        result['pop_2020'] = result['pop_2020'].fillna(0)
-        result['avg_d_kbps_w'] = result['avg_d_kbps'] * result['pop_2020'] # pop weight
-        result['avg_d_kbps'] = result['avg_d_kbps'] * result['tests'] # tests weight
-        
-        avg_d_kbps_by_country = result.groupby('Country').agg({
-            'avg_d_kbps': 'sum',
-            'avg_d_kbps_w': 'sum',
-            'tests': 'sum',
-            'pop_2020': 'sum',
-        })
-
-        # Format variables
-        avg_d_kbps_by_country['avg_d_mbps'] = round(avg_d_kbps_by_country['avg_d_kbps'] / avg_d_kbps_by_country['tests'] / 1000, 1)
-        avg_d_kbps_by_country['avg_d_mbps_w'] = round(avg_d_kbps_by_country['avg_d_kbps_w'] / avg_d_kbps_by_country['pop_2020'] / 1000, 1)
-        avg_d_kbps_by_country['k_tests'] = round(avg_d_kbps_by_country['tests'] / 1000, 1)
-        
-        # Append
-        avg_d_kbps_by_country = avg_d_kbps_by_country[['avg_d_mbps', 'avg_d_mbps_w', 'k_tests']]
-        avg_d_kbps_by_country['year'] = year
-        avg_d_kbps_by_country['d_type'] = d_type
+# Tile metrics summarised by country, with the name and scale of their country averages
+metric_columns = ['avg_d_kbps', 'avg_u_kbps', 'avg_lat_ms']
+summary_metrics = {
+    'avg_d_kbps': ('avg_d_mbps', 1000),
+    'avg_u_kbps': ('avg_u_mbps', 1000),
+    'avg_lat_ms': ('avg_lat_ms', 1),
+}
+
+# Quantiles of the tile download speeds reported with --distribution
+distribution_quantiles = [0.1, 0.5, 0.9]
+
+# Columns of the yearly tables used by the summary
+input_columns = ['quadkey_int'] + metric_columns + [f'{col}_x_tests' for col in metric_columns] + ['tests', 'pop_2020']
+
+# Parser
+def parse_args():
+    parser = argparse.ArgumentParser(description='Summarise internet speed by country.')
+    parser.add_argument('--base_path', type=str, default=default_base_path, help='Base path for input and output data')
+    parser.add_argument('--years', type=str, default=','.join(map(str, years)), help='Comma-separated list of years')
+    parser.add_argument('--distribution', action='store_true', help='Also report weighted quantiles of tile speeds and a bootstrap interval of avg_d_mbps_w')
+    parser.add_argument('--workers', type=int, default=1, help='Summarise the (year, type) tables on this many processes')
+    parser.add_argument('--cube_only', action='store_true', help='Only rebuild the summary cube from the existing summary CSV')
+    parser.add_argument('--polygons', type=str, default=None, help='Summarise by the polygons of this file instead of by country')
+    parser.add_argument('--id_column', type=str, default=None, help='Column naming the polygons of --polygons')
+    parser.add_argument('--area_fraction', action='store_true', help='Split boundary tiles between polygons by area instead of by corner point')
+    instrumentation.add_arguments(parser, default_profile_stage='sjoin')
+    return parser.parse_args()
+
+def shapefile_file(base_path):
+    return f'{base_path}/raw_data/wb_countries/WB_countries_Admin0_10m.shp'
+
+def summary_file(base_path):
+    return f'{base_path}/summary_data/internet_speed_summary_by_country.csv'
+
+def polygon_summary_file(base_path, polygons_path, area_fraction=False):
+    layer_name = os.path.splitext(os.path.basename(polygons_path))[0]
+    suffix = '_area' if area_fraction else ''
+    return f'{base_path}/summary_data/internet_speed_summary_by_{layer_name}{suffix}.csv'
+
+# Read WB Boundaries
+def load_countries(shapefile_path):
+    gdf = gpd.read_file(shapefile_path)
+    gdf = gdf[['POP_EST', 'GDP_MD_EST', 'ISO_N3', 'WB_A3', 'REGION_WB', 'NAME_EN', 'geometry']]
+    gdf = gdf.rename(columns={'NAME_EN': 'Country'})
+    gdf['ISO_N3'] = gdf['ISO_N3'].astype(int)
+    #   gdf['geometry'] = gdf['geometry'].translate(xoff=-0.000000000100041)  # Fix Rounding Issue in WB Boundaries Data
+    return gdf.reset_index(drop=True)
+
+# Country metrics of one year and type; returns the metrics and the (possibly extended) lookup
+def summarise_by_country(input_internet, lookup, gdf, year, d_type, distribution=False):
+    if 'quadkey_int' not in input_internet:
+        input_internet['quadkey_int'] = quadkey_int.encode(input_internet['quadkey'])
+
+    # Spatially join only the tiles that are not in the lookup yet
+    with stage('sjoin', rows_in=len(input_internet), year=year, d_type=d_type) as record:
+        lookup, n_new = country_lookup.update_lookup(lookup, input_internet['quadkey_int'], gdf)
+        record['rows_out'] = n_new
+    print(f'{year} {d_type}: {n_new} new tiles added to the country lookup')
+
+    # Find which country each tile falls into with a hash join on the integer key
+    with stage('merge', rows_in=len(input_internet), step='country_lookup', year=year, d_type=d_type) as record:
+        result = input_internet.merge(lookup[['quadkey_int', 'Country']], on='quadkey_int', how='inner')
+        result = result.dropna(subset=['Country']).set_index('Country')
+        record['rows_out'] = len(result)
+
+    metrics = tile_metrics(result)
+    weights = {'tests': result['tests'].to_numpy(dtype='float64'), 'pop_2020': result['pop_2020'].fillna(0).to_numpy()}
+    summary = summarise_by_key(result, result.index.to_numpy(), metrics, weights, 'Country', year, d_type, distribution)
+    return summary, lookup
+
+# Tile averages are stored as float32, recompute them in float64 from the additive sums when available
+def tile_metrics(tiles):
+    metrics = [col for col in metric_columns if col in tiles]
+    for col in metrics:
+        if f'{col}_x_tests' in tiles:
+            tiles[col] = tiles[f'{col}_x_tests'] / tiles['tests'].astype('float64')
+    return metrics
+
+# Summary metrics by key of the tiles, weighted by tests and by population (`weights`, one value per tile)
+def summarise_by_key(tiles, keys, metrics, weights, key_name, year, d_type, distribution=False):
+    # Get Internet averages weighted by tests and weighted by Pop, in one pass over the tiles
+    with stage('groupby', rows_in=len(tiles), year=year, d_type=d_type) as record:
+        by_key = weighted_agg.weighted_average(
+            keys,
+            {col: tiles[col].to_numpy(dtype='float64') for col in metrics},
+            weights,
+            key_name=key_name,
+        )
+        record['rows_out'] = len(by_key)
+
+    # Format variables
+    summary = pd.DataFrame(index=by_key.index)
+    for col, (name, scale) in summary_metrics.items():
+        if col in metrics:
+            summary[name] = round(by_key[f'{col}_w_tests'] / scale, 1)
+            summary[f'{name}_w'] = round(by_key[f'{col}_w_pop_2020'] / scale, 1)
+    summary['k_tests'] = round(by_key['tests'] / 1000, 1)
+    if distribution:
+        summary = summary.join(speed_distribution(tiles, keys, weights, year, d_type))
+
+    summary['year'] = year
+    summary['d_type'] = d_type
+    return summary
+
+# Weighted quantiles of the tile download speeds (by tests and by population) and a bootstrap
+# interval of the population-weighted average, by key. Quantiles come from a mergeable sketch,
+# so the tiles of a key are never sorted together.
+def speed_distribution(tiles, keys, weights, year, d_type):
+    codes, unique_keys = pd.factorize(keys, sort=True)
+    speed = tiles['avg_d_kbps'].to_numpy(dtype='float64')
+
+    with stage('distribution', rows_in=len(tiles), year=year, d_type=d_type) as record:
+        distribution = pd.DataFrame(index=unique_keys)
+        for weight_name, suffix in [('tests', ''), ('pop_2020', '_w')]:
+            sketch = weighted_sketch.QuantileSketch().add(codes, speed, weights[weight_name])
+            quantiles = sketch.quantiles(distribution_quantiles).reindex(range(len(unique_keys))).set_axis(unique_keys)
+            for q in distribution_quantiles:
+                distribution[f'p{round(q * 100)}_d_mbps{suffix}'] = round(quantiles[q] / 1000, 1)
+
+        # Same draws for a (year, type) in serial and parallel runs
+        seed = [year, *d_type.encode()]
+        sum_w, sum_xw = weighted_sketch.bootstrap_sums(codes, len(unique_keys), speed, weights['pop_2020'], seed=seed)
+        low, high = weighted_sketch.bootstrap_interval(sum_w, sum_xw)
+        distribution['avg_d_mbps_w_low'] = np.round(low / 1000, 1)
+        distribution['avg_d_mbps_w_high'] = np.round(high / 1000, 1)
+        record['rows_out'] = len(distribution)
+    return distribution
+
+# Metrics by polygon of one year and type, for tiles matched with a polygon cover (see polygon_cover.py)
+def summarise_by_polygon(input_internet, cover, polygons, id_column, year, d_type, distribution=False):
+    with stage('merge', rows_in=len(input_internet), step='polygon_cover', year=year, d_type=d_type) as record:
+        rows, polygon, fraction = polygon_cover.assign_tiles(input_internet['quadkey_int'], cover)
+        result = input_internet.iloc[rows].reset_index(drop=True)
+        record['rows_out'] = len(result)
+
+    # Tiles split between polygons count with their share of the tile
+    metrics = tile_metrics(result)
+    weights = {
+        'tests': result['tests'].to_numpy(dtype='float64') * fraction,
+        'pop_2020': result['pop_2020'].fillna(0).to_numpy() * fraction,
+    }
+    ids = polygons[id_column].to_numpy()[polygon]
+    return summarise_by_key(result, ids, metrics, weights, id_column, year, d_type, distribution)
+
+# Summarise (year, type, tile table) items in order; tables may come from disk or straight from memory
+def summarise_all(items, base_path, distribution=False):
+    shapefile_path = shapefile_file(base_path)
+    gdf = load_countries(shapefile_path)
+
+    # Quadkey -> country lookup shared by all years and types (built once, extended with new tiles only)
+    lookup_file = country_lookup.lookup_path(base_path, zoom_level, country_lookup.shapefile_hash(shapefile_path))
+    lookup = country_lookup.load_lookup(lookup_file)
+    n_lookup = len(lookup)
+
+    all_data = []
+    for year, d_type, input_internet in items:
+        avg_d_kbps_by_country, lookup = summarise_by_country(input_internet, lookup, gdf, year, d_type, distribution)
         all_data.append(avg_d_kbps_by_country)
-        
-#----------------------------------#
-# CONCAT AND EXPORT
 
-# Add Data to GDF and export
-concat_data = pd.concat(all_data, axis=0)
+    # Persist the lookup for later runs
+    if len(lookup) > n_lookup:
+        country_lookup.save_lookup(lookup, lookup_file)
+
+    return pd.concat(all_data, axis=0)
+
+# Country metrics of one yearly table, in a worker process: countries come from the memory-mapped lookup arrays
+def summarise_file(input_path, keys_path, codes_path, countries, year, d_type, distribution=False):
+    with stage('parquet_read', bytes_read=os.path.getsize(input_path), path=input_path) as record:
+        tiles = intermediate_io.read_intermediate(input_path, columns=input_columns)
+        record['rows_out'] = len(tiles)
+
+    with stage('merge', rows_in=len(tiles), step='country_lookup', year=year, d_type=d_type) as record:
+        codes = country_lookup.lookup_codes(tiles['quadkey_int'], keys_path, codes_path)
+        found = codes >= 0
+        result, codes = tiles[found].reset_index(drop=True), codes[found]
+        record['rows_out'] = len(result)
+
+    # Codes follow the sorted country names, so the groups come out in the order of the serial run
+    metrics = tile_metrics(result)
+    weights = {'tests': result['tests'].to_numpy(dtype='float64'), 'pop_2020': result['pop_2020'].fillna(0).to_numpy()}
+    summary = summarise_by_key(result, codes, metrics, weights, 'Country', year, d_type, distribution)
+    summary.index = pd.Index(countries[summary.index.to_numpy()], name='Country')
+    return summary
+
+# Summarise the yearly tables of `years` on a process pool.
+# The lookup is extended here, so the country polygons never leave this process;
+# the workers only memory-map its key and code arrays. Results keep the (year, type) order.
+def summarise_parallel(base_path, workers, years=years, types=types, distribution=False):
+    shapefile_path = shapefile_file(base_path)
+    gdf = load_countries(shapefile_path)
+    lookup_file = country_lookup.lookup_path(base_path, zoom_level, country_lookup.shapefile_hash(shapefile_path))
+    lookup = country_lookup.load_lookup(lookup_file)
+    n_lookup = len(lookup)
+
+    jobs = []
+    for year in years:
+        for d_type in types:
+            input_path = intermediate_io.find_yearly_file(base_path, d_type, year, zoom_level)
+            keys = intermediate_io.read_intermediate(input_path, columns=['quadkey_int'])['quadkey_int']
+            with stage('sjoin', rows_in=len(keys), year=year, d_type=d_type) as record:
+                lookup, n_new = country_lookup.update_lookup(lookup, keys, gdf)
+                record['rows_out'] = n_new
+            print(f'{year} {d_type}: {n_new} new tiles added to the country lookup')
+            jobs.append((input_path, year, d_type))
+
+    if len(lookup) > n_lookup:
+        country_lookup.save_lookup(lookup, lookup_file)
+    keys_path, codes_path, countries = country_lookup.save_lookup_arrays(lookup, lookup_file)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=partial(instrumentation.configure, **instrumentation.config())) as pool:
+        futures = [pool.submit(summarise_file, input_path, keys_path, codes_path, countries, year, d_type, distribution) for input_path, year, d_type in jobs]
+        return pd.concat([future.result() for future in futures], axis=0)
+
+# Summarise (year, type, tile table) items by the polygons of another layer (admin-1 regions, metro areas, ...)
+def summarise_polygons(items, base_path, polygons_path, id_column, area_fraction=False, distribution=False):
+    polygons = polygon_cover.load_polygons(polygons_path, id_column)
+    with stage('polygon_cover', rows_in=len(polygons), path=polygons_path) as record:
+        cover = polygon_cover.polygon_file_cover(polygons_path, polygons, base_path, zoom_level, area_fraction)
+        record['rows_out'] = len(cover)
+
+    all_data = [summarise_by_polygon(input_internet, cover, polygons, id_column, year, d_type, distribution) for year, d_type, input_internet in items]
+    return pd.concat(all_data, axis=0)
+
+# Replace the (year, type) blocks of an existing summary with newly computed ones
+def update_summary(summary_path, new_data, years=years, types=types):
+    if not os.path.exists(summary_path):
+        return new_data
+
+    old_data = pd.read_csv(summary_path, index_col='Country')
+    replaced = set(zip(new_data['year'], new_data['d_type']))
+    keep = [(year, d_type) not in replaced for year, d_type in zip(old_data['year'], old_data['d_type'])]
+
+    # Columns of the new blocks, plus optional ones (e.g. --distribution) that kept blocks still fill,
+    extra = [col for col in old_data.columns if col not in new_data.columns and old_data.loc[keep, col].notna().any()]
+    # placed before year/d_type as in a full run
+    metrics = [col for col in new_data.columns if col not in ('year', 'd_type')]
+    concat_data = pd.concat([old_data[keep], new_data], axis=0)[metrics + extra + ['year', 'd_type']]
+
+    # Restore the (year, type) order of a full run
+    order = {(year, d_type): i for i, (year, d_type) in enumerate((y, t) for y in years for t in types)}
+    position = [order.get((year, d_type), len(order)) for year, d_type in zip(concat_data['year'], concat_data['d_type'])]
+    return concat_data.iloc[pd.Series(position).argsort(kind='stable').to_numpy()]
+
+# Write the summary CSV and the precomputed cube read by the notebook and the Shiny app
+def write_summary(concat_data, base_path):
+    concat_data.to_csv(summary_file(base_path), index=True)
+    gdf = load_countries(shapefile_file(base_path))
+    summary_cube.write_cube(concat_data, gdf, summary_cube.cube_dir(base_path))
+
+def read_yearly_tiles(base_path, years=years, types=types):
+    for year in years:
+        for d_type in types:
+            # Read Internet Data
+            input_internet = intermediate_io.find_yearly_file(base_path, d_type, year, zoom_level)
+            with stage('parquet_read', bytes_read=os.path.getsize(input_internet), path=input_internet) as record:
+                tiles = intermediate_io.read_intermediate(input_internet, columns=input_columns)
+                record['rows_out'] = len(tiles)
+            yield year, d_type, tiles
+
+def main():
+    args = parse_args()
+    instrumentation.configure_from_args(args)
+    base_path = args.base_path
+    run_years = [int(year) for year in args.years.split(',')]
+
+    if args.cube_only:
+        gdf = load_countries(shapefile_file(base_path))
+        summary_cube.write_cube(pd.read_csv(summary_file(base_path)), gdf, summary_cube.cube_dir(base_path))
+        return
+
+    if args.polygons:
+        if args.id_column is None:
+            raise SystemExit('--polygons needs --id_column')
+        polygon_data = summarise_polygons(read_yearly_tiles(base_path, run_years), base_path, args.polygons, args.id_column, args.area_fraction, args.distribution)
+        output_path = polygon_summary_file(base_path, args.polygons, args.area_fraction)
+        with stage('export', rows_in=len(polygon_data), path=output_path):
+            polygon_data.to_csv(output_path, index=True)
+        return
+
+    #----------------------------------#
+    # CALCULATE COUNTRY METRICS
+
+    if args.workers > 1:
+        concat_data = summarise_parallel(base_path, args.workers, run_years, distribution=args.distribution)
+    else:
+        concat_data = summarise_all(read_yearly_tiles(base_path, run_years), base_path, args.distribution)
+
+    #----------------------------------#
+    # CONCAT AND EXPORT
+
+    # Only the (year, type) blocks of this run replace those of the existing summary
+    concat_data = update_summary(summary_file(base_path), concat_data)
+    with stage('export', rows_in=len(concat_data), path=summary_file(base_path)):
+        write_summary(concat_data, base_path)
 
-output_file =f'{base_path}/summary_data/internet_speed_summary_by_country.csv'
-concat_data.to_csv(output_file, index=True)
+    #gdf_w_data = gdf.merge(concat_data, left_on='Country', right_index=True, how='left')
+    #gdf_w_data.to_file(f'{base_path}/data/summary_by_country.geojson', driver='GeoJSON')
 
-#gdf_w_data = gdf.merge(concat_data, left_on='Country', right_index=True, how='left')
-#gdf_w_data.to_file(f'{base_path}/data/summary_by_country.geojson', driver='GeoJSON')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
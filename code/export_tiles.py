@@ -0,0 +1,236 @@
+import argparse
+import getpass
+import os
+import sqlite3
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+import instrumentation
+import intermediate_io
+import quadkey_int
+from instrumentation import stage
+
+# Raster map tiles of weighted speed, built from the yearly by_quadkey tables
+#
+# A 256 px map tile at zoom z covers the quadkeys of level z + 8 one pixel
+# each, so the data at zoom level L is drawn at native resolution by the
+# tiles of zoom L - 8 and every coarser tile is the 2x2 sum of its four
+# children. Tiles carry additive sums (speed x tests, tests, speed x pop,
+# pop) and are only turned into colours when written, so each level is exact.
+#
+# The work is split by subtree: one job per tile of --split_zoom reads only
+# the rows under that tile (a quadkey range, pushed down to the parquet row
+# groups), builds its tiles bottom-up and returns the sums of its root tile;
+# the levels above the split zoom are built from those roots. Tiles are
+# written to one MBTiles file per metric (avg_d_mbps and the
+# population-weighted avg_d_mbps_w), which tile servers and
+# `pmtiles convert` read directly.
+
+username = getpass.getuser()
+default_base_path = f'/home/{username}/GitHub/Pop-Weighted-Internet-Speed'
+
+TILE_METRICS = ['avg_d_mbps', 'avg_d_mbps_w']
+
+# Sum channels of a tile: download speed x tests, tests, download speed x population, population
+X_TESTS, TESTS, X_POP, POP = range(4)
+
+# Colour scale (Mbps) shared by every tile, with the greens of the notebook maps
+SPEED_BINS = np.array([2, 5, 10, 20, 40, 70, 100, 200, 500])
+PALETTE = np.array([
+    [247, 252, 245], [229, 245, 224], [199, 233, 192], [161, 217, 155], [116, 196, 118],
+    [49, 163, 84], [0, 109, 44], [0, 90, 41], [0, 68, 27], [0, 53, 29],
+], dtype=np.uint8)
+
+# Parser
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export zoomable map tiles of weighted internet speed.')
+    parser.add_argument('--year', type=int, default=2023, help='Year of the data')
+    parser.add_argument('--d_type', type=str, choices=['mobile', 'fixed'], default='fixed', help='Data type: mobile or fixed')
+    parser.add_argument('--zoom_level', type=int, default=13, help='Zoom level of the by_quadkey table')
+    parser.add_argument('--base_path', type=str, default=default_base_path, help='Base path for input and output data')
+    parser.add_argument('--tile_size', type=int, default=256, help='Tile size in pixels (a power of 2)')
+    parser.add_argument('--split_zoom', type=int, default=None, help='Zoom of the subtrees built by each job (default: 3 levels above the finest tiles)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    instrumentation.add_arguments(parser, default_profile_stage='tile_build')
+    return parser.parse_args()
+
+def tiles_dir(base_path):
+    return f'{base_path}/data/tiles'
+
+def mbtiles_file(base_path, d_type, year, metric):
+    return f'{tiles_dir(base_path)}/internet_speed_{d_type}_{year}_{metric}.mbtiles'
+
+# Zoom of the tiles drawing the data at one pixel per quadkey
+def native_zoom(zoom_level, tile_size):
+    return zoom_level - int(np.log2(tile_size))
+
+# Sums of the tiles at `zoom` (one pixel per quadkey of the data level) from the rows of a yearly table
+def native_tiles(all_data, zoom, tile_size):
+    x, y, _ = quadkey_int.to_tile_xy(all_data['quadkey_int'].to_numpy(dtype=np.uint64))
+    shift = int(np.log2(tile_size))
+    tile_x, tile_y = x >> shift, y >> shift
+    pixel = ((y & (tile_size - 1)) * tile_size + (x & (tile_size - 1))).astype(np.int64)
+
+    tests = all_data['tests'].to_numpy(dtype='float64')
+    pop = np.nan_to_num(all_data['pop_2020'].to_numpy(dtype='float64'))
+    if 'avg_d_kbps_x_tests' in all_data:
+        x_tests = all_data['avg_d_kbps_x_tests'].to_numpy(dtype='float64')
+    else:
+        x_tests = all_data['avg_d_kbps'].to_numpy(dtype='float64') * tests
+    # Tiles without tests add their population with a zero speed (as in the summary), never a 0/0 NaN
+    # that the parent sums would spread to every ancestor tile
+    speed = np.divide(x_tests, tests, out=np.zeros_like(x_tests), where=tests > 0)
+    channels = [x_tests, tests, speed * pop, pop]
+
+    # One bincount per channel over (tile, pixel) bins
+    tile_ids, inverse = np.unique(tile_x * (1 << zoom) + tile_y, return_inverse=True)
+    bins = inverse * tile_size * tile_size + pixel
+    sums = np.stack([
+        np.bincount(bins, weights=channel, minlength=len(tile_ids) * tile_size * tile_size)
+        for channel in channels
+    ]).reshape(4, len(tile_ids), tile_size, tile_size).swapaxes(0, 1)
+    return {
+        (zoom, int(tile_id >> zoom), int(tile_id & ((1 << zoom) - 1))): tile_sums
+        for tile_id, tile_sums in zip(tile_ids, sums)
+    }
+
+# Sums of the parent tiles, each from the 2x2 sums of its (up to four) children
+def parent_tiles(tiles, tile_size):
+    mosaics = {}
+    for (zoom, x, y), sums in tiles.items():
+        key = (zoom - 1, x >> 1, y >> 1)
+        if key not in mosaics:
+            mosaics[key] = np.zeros((4, 2 * tile_size, 2 * tile_size))
+        row, col = (y & 1) * tile_size, (x & 1) * tile_size
+        mosaics[key][:, row:row + tile_size, col:col + tile_size] = sums
+    return {key: mosaic.reshape(4, tile_size, 2, tile_size, 2).sum(axis=(2, 4)) for key, mosaic in mosaics.items()}
+
+def encode_png(rgba):
+    # Minimal RGBA PNG encoder (zlib only)
+    height, width, _ = rgba.shape
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b'')
+
+# PNG of one metric of a tile; pixels without tests (or without population for the weighted speed) are transparent
+def render_tile(sums, metric):
+    value_sum, weight = (sums[X_TESTS], sums[TESTS]) if metric == 'avg_d_mbps' else (sums[X_POP], sums[POP])
+    valid = weight > 0
+    mbps = np.divide(value_sum, weight, out=np.zeros_like(value_sum), where=valid) / 1000
+
+    rgba = np.zeros(sums.shape[1:] + (4,), dtype=np.uint8)
+    rgba[..., :3] = PALETTE[np.searchsorted(SPEED_BINS, mbps, side='right')]
+    rgba[..., 3] = np.where(valid, 255, 0)
+    return encode_png(rgba)
+
+def rendered(tiles):
+    return [(key, {metric: render_tile(sums, metric) for metric in TILE_METRICS}) for key, sums in tiles.items()]
+
+# Build the subtree under one tile of the split zoom; returns its rendered tiles and the sums of its root
+def subtree_job(input_path, zoom_level, root, tile_size):
+    split_zoom, root_x, root_y = root
+    zoom = native_zoom(zoom_level, tile_size)
+
+    # Only the quadkeys under the root tile are read
+    root_key = quadkey_int.from_tile_xy(np.array([root_x]), np.array([root_y]), split_zoom)
+    filters = intermediate_io.tile_range_filters(root_key, zoom_level)
+    with stage('parquet_read', path=input_path, tile=list(root)) as record:
+        all_data = intermediate_io.read_intermediate(
+            input_path, columns=['quadkey_int', 'avg_d_kbps', 'avg_d_kbps_x_tests', 'tests', 'pop_2020'], filters=filters)
+        record['rows_out'] = len(all_data)
+
+    with stage('tile_build', rows_in=len(all_data), tile=list(root)) as record:
+        tiles = native_tiles(all_data, zoom, tile_size)
+        output = rendered(tiles)
+        while zoom > split_zoom:
+            tiles = parent_tiles(tiles, tile_size)
+            zoom -= 1
+            output += rendered(tiles)
+        record['rows_out'] = len(output)
+    return output, tiles.get(root)
+
+# Tiles of the split zoom that have data
+def split_roots(input_path, zoom_level, split_zoom):
+    keys = intermediate_io.read_intermediate(input_path, columns=['quadkey_int'])['quadkey_int'].to_numpy(dtype=np.uint64)
+    x, y, _ = quadkey_int.to_tile_xy(np.unique(quadkey_int.parent(keys, split_zoom)))
+    return [(split_zoom, int(tile_x), int(tile_y)) for tile_x, tile_y in zip(x, y)]
+
+def create_mbtiles(path, metadata):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+    db.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    db.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+    return db
+
+def write_tiles(dbs, output):
+    for (zoom, x, y), pngs in output:
+        # MBTiles rows count from the south (TMS)
+        for metric, png in pngs.items():
+            dbs[metric].execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (zoom, x, (1 << zoom) - 1 - y, png))
+
+def export_tiles(input_path, output_paths, zoom_level, tile_size=256, split_zoom=None, workers=None, description=''):
+    zoom = native_zoom(zoom_level, tile_size)
+    if zoom < 0:
+        raise ValueError(f'zoom level {zoom_level} is too coarse for {tile_size} px tiles')
+    split_zoom = max(0, zoom - 3) if split_zoom is None else min(split_zoom, zoom)
+
+    dbs = {
+        metric: create_mbtiles(path, {
+            'name': os.path.basename(path)[:-len('.mbtiles')],
+            'format': 'png',
+            'type': 'overlay',
+            'version': '1',
+            'description': f'{description} {metric}'.strip(),
+            'minzoom': '0',
+            'maxzoom': str(zoom),
+            'bounds': '-180.0,-85.0511,180.0,85.0511',
+        })
+        for metric, path in output_paths.items()
+    }
+
+    # Subtrees below the split zoom run in parallel, each reading only its own quadkey range
+    roots = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=partial(instrumentation.configure, **instrumentation.config())) as pool:
+        futures = {root: pool.submit(subtree_job, input_path, zoom_level, root, tile_size)
+                   for root in split_roots(input_path, zoom_level, split_zoom)}
+        for root, future in futures.items():
+            output, roots[root] = future.result()
+            write_tiles(dbs, output)
+
+    # Levels above the split zoom, each tile from its four children
+    tiles = roots
+    for _ in range(split_zoom):
+        tiles = parent_tiles(tiles, tile_size)
+        write_tiles(dbs, rendered(tiles))
+
+    for db in dbs.values():
+        db.commit()
+        db.close()
+
+def main():
+    args = parse_args()
+    instrumentation.configure_from_args(args)
+
+    input_path = intermediate_io.find_yearly_file(args.base_path, args.d_type, args.year, args.zoom_level)
+    output_paths = {metric: mbtiles_file(args.base_path, args.d_type, args.year, metric) for metric in TILE_METRICS}
+
+    export_tiles(input_path, output_paths, args.zoom_level, args.tile_size, args.split_zoom, args.workers,
+                 description=f'{args.year} {args.d_type} internet speed')
+
+    for path in output_paths.values():
+        print(f'Tiles exported to {path}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import manifest
+import read_and_group_ookla as rg
+
+# Concurrent, resumable download of the Ookla raw tiles files
+#
+# Replaces the serial `aws s3 sync` loop of main.sh. Each (year, quarter,
+# type) object is downloaded on a thread pool into `{file}.part`, resumed
+# with a ranged request after an interruption, verified against the size
+# (and MD5 ETag, when the object has one) of the remote object and only then
+# renamed to the name read_and_group_ookla.py expects. Sizes and ETags of
+# the downloaded files are kept in `fetch_manifest.json` of the raw folder,
+# so files that did not change upstream are not downloaded again.
+#
+# The endpoint is pluggable: the public bucket over HTTPS (no credentials,
+# like --no-sign-request), any S3-compatible server (MinIO, moto, ...) given
+# as http://host:port/bucket, or a local mirror given as file:///path, all
+# with the bucket's key layout.
+
+DEFAULT_ENDPOINT = 'https://ookla-open-data.s3.amazonaws.com'
+FETCH_MANIFEST = 'fetch_manifest.json'
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MD5_ETAG = re.compile(r'^[0-9a-f]{32}$')
+
+# Parser
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download the Ookla raw tiles files.')
+    parser.add_argument('--years', type=str, default='2019,2020,2021,2022,2023,2024', help='Comma-separated list of years')
+    parser.add_argument('--types', type=str, default='fixed,mobile', help='Comma-separated list of internet types')
+    parser.add_argument('--raw_speed_folder', type=str, required=True, help='Local folder of the raw tiles files')
+    parser.add_argument('--endpoint_url', type=str, default=DEFAULT_ENDPOINT, help='Bucket URL (https://, http:// or file://)')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent downloads')
+    parser.add_argument('--retries', type=int, default=3, help='Attempts per file before giving up')
+    return parser.parse_args()
+
+def object_key(year, q, d_type):
+    quarter = (int(q) - 1) // 3 + 1
+    name = os.path.basename(rg.tiles_file('', year, q, d_type))
+    return f'parquet/performance/type={d_type}/year={year}/quarter={quarter}/{name}'
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# S3 or S3-compatible bucket over HTTP(S): HEAD for size/ETag, ranged GET for resumed downloads
+class HttpEndpoint:
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, key, method='GET', headers=None):
+        url = f"{self.url}/{urllib.parse.quote(key, safe='/=')}"
+        return urllib.request.urlopen(urllib.request.Request(url, method=method, headers=headers or {}), timeout=self.timeout)
+
+    # Size and ETag of an object, or None when it does not exist
+    def stat(self, key):
+        try:
+            with self._request(key, method='HEAD') as response:
+                return {'size': int(response.headers['Content-Length']), 'etag': response.headers.get('ETag', '').strip('"')}
+        except urllib.error.HTTPError as error:
+            if error.code in (403, 404):
+                return None
+            raise
+
+    # Stream of the object from byte `start`, and whether the server resumed there.
+    # If-Range makes the server send the whole object instead when it changed since the partial download.
+    def open(self, key, start, etag):
+        headers = {'Range': f'bytes={start}-', 'If-Range': f'"{etag}"'} if start else {}
+        response = self._request(key, headers=headers)
+        return response, response.status == 206
+
+# Local mirror with the bucket's layout; the MD5 of each file stands in for the ETag
+class FileEndpoint:
+    def __init__(self, url):
+        self.root = urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+
+    def stat(self, key):
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            return None
+        return {'size': os.path.getsize(path), 'etag': file_md5(path)}
+
+    def open(self, key, start, etag):
+        f = open(os.path.join(self.root, key), 'rb')
+        f.seek(start)
+        return f, True
+
+def endpoint_from_url(url):
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme == 'file':
+        return FileEndpoint(url)
+    if scheme in ('http', 'https'):
+        return HttpEndpoint(url)
+    raise ValueError(f'Unsupported endpoint: {url} (use https://, http:// or file://)')
+
+# A download that does not match the remote object; retried like network errors
+class DownloadError(OSError):
+    pass
+
+# Whether a downloaded file matches the remote object: size, and content when the ETag is an MD5
+# (multipart uploads have "{md5}-{parts}" ETags, those files are checked on size only)
+def verify(path, remote):
+    if os.path.getsize(path) != remote['size']:
+        return False
+    if MD5_ETAG.match(remote['etag']):
+        return file_md5(path) == remote['etag']
+    return True
+
+# Call `fn` up to `retries` times (at least once), backing off between failed attempts
+def with_retries(fn, retries=3):
+    attempts = max(1, retries)
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except OSError:
+            if attempt + 1 == attempts:
+                raise
+            time.sleep(2 ** attempt)
+
+# Download one object to `dest_path`, resuming from `{dest_path}.part`
+def download(endpoint, key, dest_path, remote, retries=3, chunk_size=CHUNK_SIZE):
+    part_path = f'{dest_path}.part'
+
+    def attempt():
+        start = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if start > remote['size']:
+            start = 0
+        if start < remote['size']:
+            stream, resumed = endpoint.open(key, start, remote['etag'])
+            with stream, open(part_path, 'ab' if resumed else 'wb') as f:
+                shutil.copyfileobj(stream, f, chunk_size)
+
+        if not verify(part_path, remote):
+            # Corrupt or stale partial file, start over
+            os.remove(part_path)
+            raise DownloadError(f'{key}: downloaded file does not match the remote size/checksum')
+        os.replace(part_path, dest_path)
+
+    with_retries(attempt, retries)
+
+# Download pool; submit() returns a future of the local path of a tiles file (None when the object does not exist)
+class Fetcher:
+    def __init__(self, endpoint_url, dest_dir, workers=8, retries=3):
+        self.endpoint = endpoint_from_url(endpoint_url)
+        self.dest_dir = dest_dir
+        self.retries = retries
+        self.manifest_path = os.path.join(dest_dir, FETCH_MANIFEST)
+        self.manifest = manifest.load_manifest(self.manifest_path)
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def submit(self, year, q, d_type):
+        return self.pool.submit(self.fetch, year, q, d_type)
+
+    def fetch(self, year, q, d_type):
+        key = object_key(year, q, d_type)
+        dest_path = rg.tiles_file(self.dest_dir, year, q, d_type)
+        remote = with_retries(lambda: self.endpoint.stat(key), self.retries)
+        if remote is None:
+            return None
+
+        # Same size and ETag as when it was last downloaded: nothing to do
+        name = os.path.basename(dest_path)
+        with self.lock:
+            entry = self.manifest.get(name)
+        if entry == {'key': key, **remote} and os.path.exists(dest_path) and os.path.getsize(dest_path) == remote['size']:
+            return dest_path
+
+        # A file already in the raw folder (e.g. from an earlier `aws s3 sync`) is kept when it matches the remote object
+        if entry is None and os.path.exists(dest_path) and verify(dest_path, remote):
+            with self.lock:
+                self.manifest[name] = {'key': key, **remote}
+                manifest.save_manifest(self.manifest, self.manifest_path)
+            print(f'Verified {key} against the local copy')
+            return dest_path
+
+        download(self.endpoint, key, dest_path, remote, self.retries)
+        with self.lock:
+            self.manifest[name] = {'key': key, **remote}
+            manifest.save_manifest(self.manifest, self.manifest_path)
+        print(f'Downloaded {key} ({remote["size"] / 1024 / 1024:.1f} MB)')
+        return dest_path
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    args = parse_args()
+    years = [int(year) for year in args.years.split(',')]
+    types = args.types.split(',')
+
+    start = time.perf_counter()
+    with Fetcher(args.endpoint_url, args.raw_speed_folder, args.workers, args.retries) as fetcher:
+        futures = {
+            (year, q, d_type): fetcher.submit(year, q, d_type)
+            for year in years for q in rg.QUARTERS for d_type in types
+        }
+        for (year, q, d_type), future in futures.items():
+            if future.result() is None:
+                print(f'Not available (skipped): {object_key(year, q, d_type)}')
+
+    print(f'Data synchronization finished in {time.perf_counter() - start:.1f} s')
+
+if __name__ == '__main__':
+    main()
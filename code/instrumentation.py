@@ -0,0 +1,140 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# Per-stage instrumentation shared by the pipeline scripts
+#
+# `with stage('groupby', rows_in=n) as record:` measures wall time, CPU time
+# and the peak RSS reached inside the block, and writes them as one JSON line
+# (with rows in/out and bytes read when the caller sets them) to stderr or to
+# the file given to configure(). When profiling is enabled for a stage name,
+# that stage also runs under cProfile and its stats are dumped as a .prof file
+# (readable with pstats, snakeviz or flameprof) plus a text summary.
+
+_config = {
+    'log_path': None,
+    'enabled': True,
+    'profile_stage': None,
+    'profile_dir': '.',
+}
+_stack = []
+_profile_count = {}
+
+
+def configure(log_path=None, enabled=True, profile_stage=None, profile_dir='.'):
+    _config.update(log_path=log_path, enabled=enabled, profile_stage=profile_stage, profile_dir=profile_dir)
+
+
+def config():
+    return dict(_config)
+
+
+# Peak resident set size of this process in MB (never reset)
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Reset the kernel's peak RSS counter so a stage reports its own peak (Linux only)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Peak RSS since the last reset in MB
+def current_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def _emit(record):
+    line = json.dumps(record)
+    if _config['log_path']:
+        with open(_config['log_path'], 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(line, file=sys.stderr)
+
+
+def _profile_file(name):
+    count = _profile_count.get(name, 0)
+    _profile_count[name] = count + 1
+    os.makedirs(_config['profile_dir'], exist_ok=True)
+    return os.path.join(_config['profile_dir'], f'{name}_{os.getpid()}_{count}.prof')
+
+
+@contextmanager
+def stage(name, rows_in=None, bytes_read=None, **fields):
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'bytes_read': bytes_read, **fields}
+
+    # Nested stages reset the peak counter, so the enclosing stage keeps its peak so far
+    if _stack:
+        _stack[-1]['_peak'] = max(_stack[-1]['_peak'], current_peak_rss_mb())
+    record['_peak'] = 0.0
+    reset_peak_rss()
+    _stack.append(record)
+
+    profiler = None
+    if _config['profile_stage'] == name:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        wall_s = time.perf_counter() - wall_start
+        cpu_s = time.process_time() - cpu_start
+
+        if profiler is not None:
+            profiler.disable()
+            path = _profile_file(name)
+            profiler.dump_stats(path)
+            with open(f'{path[:-5]}.txt', 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+            record['profile'] = path
+
+        _stack.pop()
+        peak = max(record.pop('_peak'), current_peak_rss_mb())
+        if _stack:
+            _stack[-1]['_peak'] = max(_stack[-1]['_peak'], peak)
+
+        record.update({
+            'wall_s': round(wall_s, 4),
+            'cpu_s': round(cpu_s, 4),
+            'peak_rss_mb': round(peak, 1),
+            'pid': os.getpid(),
+        })
+        if _config['enabled']:
+            _emit(record)
+
+
+# Add the instrumentation options to a script's parser
+def add_arguments(parser, default_profile_stage):
+    parser.add_argument('--log_json', type=str, default=None, help='Append per-stage JSON lines to this file (default: stderr)')
+    parser.add_argument('--profile', action='store_true', help='Profile one stage with cProfile')
+    parser.add_argument('--profile_stage', type=str, default=default_profile_stage, help='Stage profiled with --profile')
+    parser.add_argument('--profile_dir', type=str, default='profiles', help='Directory of the profile outputs')
+
+
+def configure_from_args(args):
+    configure(
+        log_path=args.log_json,
+        profile_stage=args.profile_stage if args.profile else None,
+        profile_dir=args.profile_dir,
+    )
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import quadkey_int
+
+# Typed, sorted intermediate tables
+#
+# The yearly by_quadkey tables are written with compact dtypes (uint64 key,
+# float32 averages, uint32 counts widened to uint64 when a table's sums do
+# not fit; additive sums and population stay float64 so merging them is
+# exact), sorted by quadkey_int and split in row groups with statistics.
+# Readers can then skip whole row groups for tile ranges. The quadkey string is not stored, it is decoded on demand.
+
+COMPRESSIONS = ['zstd', 'lz4', 'snappy', 'gzip', 'none']
+ROW_GROUP_SIZE = 128 * 1024
+
+INTERMEDIATE_DTYPES = {
+    'quadkey_int': 'uint64',
+    'avg_d_kbps': 'float32',
+    'avg_u_kbps': 'float32',
+    'avg_lat_ms': 'float32',
+    'tests': 'uint32',
+    'devices': 'uint32',
+    'avg_d_kbps_x_tests': 'float64',
+    'avg_u_kbps_x_tests': 'float64',
+    'avg_lat_ms_x_tests': 'float64',
+    'pop_2020': 'float64',
+}
+
+
+def yearly_file(base_path, d_type, year, zoom_level, compression='zstd'):
+    suffix = '.parquet.gz' if compression == 'gzip' else '.parquet'
+    return f"{base_path}/data/internet_speed_{d_type}_{year}_by_quadkey_{zoom_level}{suffix}"
+
+
+# Existing yearly file, preferring the typed format over the legacy gzip one
+def find_yearly_file(base_path, d_type, year, zoom_level):
+    for compression in ['zstd', 'gzip']:
+        path = yearly_file(base_path, d_type, year, zoom_level, compression)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(yearly_file(base_path, d_type, year, zoom_level))
+
+
+# Dtype of a column in the intermediate table; counts summed over coarse pyramid tiles can pass 2^32
+def intermediate_dtype(values, col):
+    dtype = np.dtype(INTERMEDIATE_DTYPES[col])
+    if dtype.kind == 'u' and len(values) and values.max() > np.iinfo(dtype).max:
+        return 'uint64'
+    return dtype.name
+
+
+def to_intermediate_table(all_data):
+    all_data = all_data.sort_values('quadkey_int')
+    columns = [col for col in all_data.columns if col in INTERMEDIATE_DTYPES]
+    return pa.Table.from_pandas(
+        all_data[columns].astype({col: intermediate_dtype(all_data[col], col) for col in columns}),
+        preserve_index=False,
+    )
+
+
+def write_intermediate(all_data, path, compression='zstd', compression_level=None, row_group_size=ROW_GROUP_SIZE):
+    table = to_intermediate_table(all_data)
+    pq.write_table(
+        table, path,
+        compression=compression,
+        compression_level=compression_level,
+        row_group_size=row_group_size,
+        write_statistics=True,
+    )
+
+
+# Filters selecting the descendants (at `zoom_level`) of the given tiles
+def tile_range_filters(keys, zoom_level):
+    low, high = quadkey_int.descendant_range(keys, zoom_level)
+    return [[('quadkey_int', '>=', lo), ('quadkey_int', '<=', hi)] for lo, hi in zip(low, high)]
+
+
+# Read a yearly table; requested columns missing from older files are skipped
+def read_intermediate(path, columns=None, filters=None, with_quadkey=False):
+    names = pq.read_schema(path).names
+
+    # Legacy gzip files only have the quadkey string, the integer key is derived from it
+    legacy = 'quadkey_int' not in names
+    if legacy and filters is not None:
+        raise ValueError(f'{path} has no quadkey_int column to filter on, rewrite it with write_intermediate')
+    if columns is not None:
+        columns = ['quadkey' if legacy and col == 'quadkey_int' else col for col in columns]
+        columns = [col for col in columns if col in names]
+
+    all_data = pq.read_table(path, columns=columns, filters=filters).to_pandas()
+    if legacy:
+        all_data['quadkey_int'] = quadkey_int.encode(all_data['quadkey'])
+    if with_quadkey and 'quadkey' not in all_data:
+        all_data.insert(0, 'quadkey', quadkey_int.decode(all_data['quadkey_int']))
+    return all_data
@@ -10,6 +10,9 @@ raw_speed_folder="/media/matias/Elements SE/WB/ookla" # ~1GB of data by year and
 years="2019,2020,2021,2022,2023,2024"  # Comma-separated list of years
 sync_internet_data=0
 aggregate_data=1
+workers=0 # >0 runs the aggregation and country summary with the parallel Python driver
+endpoint_url="https://ookla-open-data.s3.amazonaws.com" # or http://host:port/bucket (S3-compatible), file:///path (mirror)
+fetch_workers=8
 
 # Parse command-line arguments
 while [[ $# -gt 0 ]]; do
@@ -39,6 +42,21 @@ while [[ $# -gt 0 ]]; do
       shift
       shift
       ;;
+    --workers)
+      workers="$2"
+      shift
+      shift
+      ;;
+    --endpoint_url)
+      endpoint_url="$2"
+      shift
+      shift
+      ;;
+    --fetch_workers)
+      fetch_workers="$2"
+      shift
+      shift
+      ;;
     *)
       echo "Unknown option: $1"
       exit 1
@@ -52,21 +70,15 @@ IFS=',' read -r -a year_array <<< "$years"
 #------------------------------------------------#
 # SYNC OOKLA DATA 
 
-if [ "$sync_internet_data" -eq 1 ]; then
+# With the parallel driver, files are downloaded and aggregated in the same run (see below)
+if [ "$sync_internet_data" -eq 1 ] && ! { [ "$aggregate_data" -eq 1 ] && [ "$workers" -gt 0 ]; }; then
   echo "Starting data synchronization..."
 
-  export FORMAT='parquet' # (shapefiles|parquet)
-
-  for year in "${year_array[@]}"; do
-    for Q in 1 2 3 4; do
-      for TYPE in 'fixed' 'mobile'; do
-        echo "Synchronizing data for year ${year}, quarter ${Q}, type ${TYPE}..."
-        aws s3 sync "s3://ookla-open-data/${FORMAT}/performance/type=${TYPE}/year=${year}/quarter=${Q}/" "$raw_speed_folder" \
-        --exact-timestamps \
-        --no-sign-request
-      done
-    done
-  done
+  python "${base_path}"/code/fetch_ookla.py \
+        --years "$years" \
+        --raw_speed_folder "${raw_speed_folder}" \
+        --endpoint_url "${endpoint_url}" \
+        --workers "$fetch_workers"
 
   echo "Data synchronization complete."
 fi
@@ -74,7 +86,23 @@ fi
 #------------------------------------------------#
 # AGGREGATE RAW DATA 
 
-if [ "$aggregate_data" -eq 1 ]; then
+if [ "$aggregate_data" -eq 1 ] && [ "$workers" -gt 0 ]; then
+  echo "Starting parallel data aggregation with $workers workers..."
+
+  fetch_args=()
+  if [ "$sync_internet_data" -eq 1 ]; then
+    fetch_args=(--fetch --endpoint_url "${endpoint_url}" --fetch_workers "$fetch_workers")
+  fi
+
+  python "${base_path}"/code/run_pipeline.py \
+        --years "$years" \
+        --speed_data_path "${raw_speed_folder}" \
+        --base_path "${base_path}" \
+        --workers "$workers" \
+        "${fetch_args[@]}"
+
+  echo "Data aggregation complete."
+elif [ "$aggregate_data" -eq 1 ]; then
   echo "Starting data aggregation..."
 
   for year in "${year_array[@]}"; do
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+
+# Manifest of raw tiles files and their aggregated intermediates
+#
+# For each raw {year}-{q}-01_performance_{d_type}_tiles.parquet the manifest
+# records size, mtime and sha256, together with the path of its per-quarter
+# sums. A file is only re-hashed when its size or mtime changed, and only
+# re-aggregated when its hash changed or its intermediate is missing.
+
+
+def manifest_file(base_path):
+    return f'{base_path}/data/manifest.json'
+
+
+def quarter_sums_file(base_path, d_type, year, q, zoom_level):
+    return f'{base_path}/data/quarters/internet_speed_{d_type}_{year}_{q}_sums_{zoom_level}.parquet'
+
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Current size/mtime/hash of a raw file, reusing the recorded hash when size and mtime are unchanged
+def fingerprint(path, entry=None):
+    stat = os.stat(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        sha256 = entry['sha256']
+    else:
+        sha256 = file_sha256(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256}
+
+
+# Whether a raw file must be (re)aggregated; returns the decision and its fingerprint
+def needs_update(manifest, raw_path, intermediate_path):
+    entry = manifest.get(os.path.basename(raw_path))
+    current = fingerprint(raw_path, entry)
+    changed = (
+        entry is None
+        or entry['sha256'] != current['sha256']
+        or entry.get('intermediate') != intermediate_path
+        or not os.path.exists(intermediate_path)
+    )
+    return changed, current
+
+
+def record(manifest, raw_path, current, intermediate_path):
+    manifest[os.path.basename(raw_path)] = {**current, 'intermediate': intermediate_path}
@@ -0,0 +1,143 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import country_lookup
+import quadkey_int
+
+# Quadkey cover of a polygon layer
+#
+# The cover lists, for each polygon, the tiles it contains: tiles lying
+# strictly inside a polygon are kept whole at the coarsest level where that
+# holds (one key stands for all its descendants), and only the tiles on the
+# polygon boundary are refined down to the zoom level of the data and tested
+# there. A boundary tile belongs to a polygon when its NW corner lies inside
+# it, as in the country lookup, or, with area_fraction, with the share of the
+# tile's area that the polygon covers (the tile's tests and population are
+# then split between polygons).
+#
+# Covers are stored on disk, keyed by zoom level, by a hash of the polygon
+# files and by the assignment rule, so aggregating tiles to a polygon layer
+# is an integer join of each tile's ancestors with the cover. Polygons may
+# overlap; a tile is counted in every polygon that covers it.
+
+COVER_COLUMNS = ['polygon', 'quadkey_int', 'fraction']
+
+
+def cover_path(base_path, layer_name, zoom_level, layer_hash, area_fraction=False):
+    rule = 'area' if area_fraction else 'point'
+    return f'{base_path}/data/cover/cover_{layer_name}_{zoom_level}_{rule}_{layer_hash}.parquet'
+
+
+# Tile boxes in lon/lat
+def tile_boxes(x, y, level):
+    lat_top, lon_left = quadkey_int.tile_xy_to_geo(x, y, level)
+    lat_bottom, lon_right = quadkey_int.tile_xy_to_geo(x, y, level, anchor_x=1.0, anchor_y=1.0)
+    return shapely.box(lon_left, lat_bottom, lon_right, lat_top)
+
+
+def _children(polygon, x, y):
+    n = len(polygon)
+    x = (np.repeat(x, 4) << np.uint64(1)) + np.tile(np.array([0, 1, 0, 1], dtype=np.uint64), n)
+    y = (np.repeat(y, 4) << np.uint64(1)) + np.tile(np.array([0, 0, 1, 1], dtype=np.uint64), n)
+    return np.repeat(polygon, 4), x, y
+
+
+def _cover_rows(polygon, x, y, level, fraction):
+    return pd.DataFrame({
+        'polygon': polygon.astype(np.int32),
+        'quadkey_int': quadkey_int.from_tile_xy(x, y, level),
+        'fraction': np.broadcast_to(np.asarray(fraction, dtype=np.float64), len(polygon)),
+    })
+
+
+# Cover of every polygon of `geometry` (in EPSG:4326) down to `zoom_level`;
+# `polygon` is the position of the polygon in `geometry`
+def build_cover(geometry, zoom_level, area_fraction=False):
+    polygons = np.asarray(geometry.values, dtype=object)
+    shapely.prepare(polygons)
+
+    # Start from the world tile and refine the boundary tiles one level at a time
+    polygon = np.flatnonzero(~shapely.is_empty(polygons) & ~shapely.is_missing(polygons))
+    x = np.zeros(len(polygon), dtype=np.uint64)
+    y = np.zeros(len(polygon), dtype=np.uint64)
+
+    parts = []
+    for level in range(zoom_level):
+        boxes = tile_boxes(x, y, level)
+        inside = shapely.contains_properly(polygons[polygon], boxes)
+        parts.append(_cover_rows(polygon[inside], x[inside], y[inside], level, 1.0))
+
+        boundary = ~inside & shapely.intersects(polygons[polygon], boxes)
+        polygon, x, y = _children(polygon[boundary], x[boundary], y[boundary])
+        candidates = shapely.intersects(polygons[polygon], tile_boxes(x, y, level + 1))
+        polygon, x, y = polygon[candidates], x[candidates], y[candidates]
+
+    # Tiles of the data level: interior ones whole, boundary ones by their corner point or their area share
+    boxes = tile_boxes(x, y, zoom_level)
+    inside = shapely.contains_properly(polygons[polygon], boxes)
+    if area_fraction:
+        fraction = np.where(
+            inside, 1.0,
+            shapely.area(shapely.intersection(polygons[polygon], boxes)) / shapely.area(boxes),
+        )
+    else:
+        lat, lon = quadkey_int.tile_xy_to_geo(x, y, zoom_level)
+        fraction = (inside | shapely.contains_xy(polygons[polygon], lon, lat)).astype(np.float64)
+    keep = fraction > 0
+    parts.append(_cover_rows(polygon[keep], x[keep], y[keep], zoom_level, fraction[keep]))
+
+    cover = pd.concat(parts, ignore_index=True)
+    return cover.sort_values(['quadkey_int', 'polygon'], ignore_index=True)
+
+
+def load_cover(path):
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    return None
+
+
+def save_cover(cover, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cover.to_parquet(path, index=False)
+
+
+# Cover of a polygon file (read with load_polygons), built once and reused while the file does not change
+def polygon_file_cover(polygons_path, gdf, base_path, zoom_level, area_fraction=False):
+    layer_name = os.path.splitext(os.path.basename(polygons_path))[0]
+    path = cover_path(base_path, layer_name, zoom_level, country_lookup.shapefile_hash(polygons_path), area_fraction)
+    cover = load_cover(path)
+    if cover is None:
+        cover = build_cover(gdf.geometry, zoom_level, area_fraction)
+        save_cover(cover, path)
+    return cover
+
+
+# Match tiles of `zoom_level` with the cover: position of each matched tile, its polygon and its fraction.
+# Each level of the cover is a hash join on the tiles' ancestors at that level.
+def assign_tiles(keys, cover):
+    keys = np.asarray(keys, dtype=np.uint64)
+    levels = quadkey_int.level_of(cover['quadkey_int'].to_numpy())
+
+    matches = []
+    for level in np.unique(levels):
+        tiles = pd.DataFrame({'quadkey_int': quadkey_int.parent(keys, int(level)), 'row': np.arange(len(keys))})
+        matches.append(tiles.merge(cover[levels == level], on='quadkey_int', how='inner'))
+    matched = pd.concat(matches, ignore_index=True) if matches else pd.DataFrame(columns=['row'] + COVER_COLUMNS)
+    return (
+        matched['row'].to_numpy(dtype=np.int64),
+        matched['polygon'].to_numpy(dtype=np.int64),
+        matched['fraction'].to_numpy(dtype=np.float64),
+    )
+
+
+def load_polygons(polygons_path, id_column):
+    gdf = gpd.read_file(polygons_path)
+    if id_column not in gdf:
+        raise ValueError(f'{polygons_path} has no column {id_column!r} (columns: {", ".join(gdf.columns)})')
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(4326)
+    return gdf[[id_column, 'geometry']].reset_index(drop=True)
@@ -0,0 +1,114 @@
+import numpy as np
+
+# Integer quadkey codec
+#
+# A quadkey of level L is packed into a uint64 as:
+#   [ 2 bits per level, left-aligned over MAX_LEVEL levels | 6 bits with L ]
+# Digits are left-aligned, so sorting the integers gives the same order as
+# sorting the quadkey strings, all descendants of a tile form a contiguous
+# range, and rolling up to a parent level is a single mask.
+
+MAX_LEVEL = 29
+LEVEL_BITS = 6
+LEVEL_MASK = np.uint64((1 << LEVEL_BITS) - 1)
+
+
+def _digit_shift(level):
+    # Bit position of the (1-based) digit at `level`
+    return LEVEL_BITS + 2 * (MAX_LEVEL - level)
+
+
+def encode(quadkeys):
+    # Encode an array/Series of quadkey strings into packed uint64 keys
+    qk = np.asarray(quadkeys, dtype=f'S{MAX_LEVEL}')
+    chars = qk.view(np.uint8).reshape(len(qk), MAX_LEVEL)
+
+    valid = chars != 0
+    levels = valid.sum(axis=1).astype(np.uint64)
+    digits = np.where(valid, chars - ord('0'), 0).astype(np.uint64)
+
+    keys = levels.copy()
+    for i in range(MAX_LEVEL):
+        keys |= digits[:, i] << np.uint64(_digit_shift(i + 1))
+    return keys
+
+
+def decode(keys):
+    # Decode packed uint64 keys back into quadkey strings
+    keys = np.asarray(keys, dtype=np.uint64)
+    levels = (keys & LEVEL_MASK).astype(np.int64)
+
+    chars = np.zeros((len(keys), MAX_LEVEL), dtype=np.uint8)
+    for i in range(MAX_LEVEL):
+        digit = (keys >> np.uint64(_digit_shift(i + 1))) & np.uint64(3)
+        chars[:, i] = np.where(levels > i, digit + ord('0'), 0)
+
+    return chars.view(f'S{MAX_LEVEL}').ravel().astype(str)
+
+
+def level_of(keys):
+    return (np.asarray(keys, dtype=np.uint64) & LEVEL_MASK).astype(np.uint8)
+
+
+def parent(keys, zoom_level):
+    # Roll keys up to their ancestor at `zoom_level` (keys must be at that level or finer)
+    keys = np.asarray(keys, dtype=np.uint64)
+    keep = ~np.uint64((1 << _digit_shift(zoom_level)) - 1)
+    return (keys & keep) | np.uint64(zoom_level)
+
+
+def to_tile_xy(keys):
+    # De-interleave the digits into tile x/y at each key's own level
+    keys = np.asarray(keys, dtype=np.uint64)
+    levels = level_of(keys).astype(np.int64)
+
+    x = np.zeros(len(keys), dtype=np.uint64)
+    y = np.zeros(len(keys), dtype=np.uint64)
+    for i in range(1, levels.max(initial=0) + 1):
+        digit = (keys >> np.uint64(_digit_shift(i))) & np.uint64(3)
+        active = levels >= i
+        x = np.where(active, (x << np.uint64(1)) | (digit & np.uint64(1)), x)
+        y = np.where(active, (y << np.uint64(1)) | (digit >> np.uint64(1)), y)
+    return x, y, levels
+
+
+def from_tile_xy(x, y, zoom_level):
+    # Interleave tile x/y at a single zoom level into packed keys
+    x = np.asarray(x, dtype=np.uint64)
+    y = np.asarray(y, dtype=np.uint64)
+
+    keys = np.full(len(x), zoom_level, dtype=np.uint64)
+    for i in range(1, zoom_level + 1):
+        bit = np.uint64(zoom_level - i)
+        digit = ((x >> bit) & np.uint64(1)) | (((y >> bit) & np.uint64(1)) << np.uint64(1))
+        keys |= digit << np.uint64(_digit_shift(i))
+    return keys
+
+
+def tile_xy_to_geo(x, y, levels, anchor_x=0.0, anchor_y=0.0):
+    # Latitude/longitude of a point inside each tile (anchor 0, 0 is the NW corner, 0.5, 0.5 the centre),
+    # using the same Web Mercator formulas as pyquadkey2
+    map_size = np.ldexp(1.0, np.asarray(levels, dtype=np.int64))
+    px = (np.asarray(x, dtype=np.float64) + anchor_x) / map_size - 0.5
+    py = 0.5 - (np.asarray(y, dtype=np.float64) + anchor_y) / map_size
+
+    lat = 90 - 360 * np.arctan(np.exp(-py * 2 * np.pi)) / np.pi
+    lon = 360 * px
+    return lat, lon
+
+
+def to_geo(keys, anchor_x=0.0, anchor_y=0.0):
+    # Vectorized equivalent of QuadKey(qk).to_geo() for whole arrays of keys
+    x, y, levels = to_tile_xy(keys)
+    return tile_xy_to_geo(x, y, levels, anchor_x, anchor_y)
+
+
+def descendant_range(keys, zoom_level):
+    # Smallest and largest key at `zoom_level` that descend from each key (inclusive bounds)
+    keys = np.asarray(keys, dtype=np.uint64)
+    levels = level_of(keys).astype(np.int64)
+    digits = keys & ~LEVEL_MASK
+    span = np.left_shift(np.uint64(1), (LEVEL_BITS + 2 * (MAX_LEVEL - levels)).astype(np.uint64)) - np.uint64(1)
+    low = digits | np.uint64(zoom_level)
+    high = ((digits | span) & ~LEVEL_MASK) | np.uint64(zoom_level)
+    return low, high
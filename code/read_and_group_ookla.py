@@ -1,6 +1,32 @@
 import argparse
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import shutil
+import tempfile
+
+import instrumentation
+import intermediate_io
+import quadkey_int
+import weighted_agg
+from instrumentation import stage
+
+# Columns needed from the raw tiles files (geometry/WKT columns are never read in streaming mode)
+TILE_COLUMNS = ['quadkey', 'avg_d_kbps', 'avg_u_kbps', 'avg_lat_ms', 'tests', 'devices']
+WEIGHTED_COLUMNS = ['avg_d_kbps', 'avg_u_kbps', 'avg_lat_ms']
+SUM_COLUMNS = WEIGHTED_COLUMNS + ['tests', 'devices']
+
+# Define the quarter indices in file paths
+QUARTERS = ["01", "04", "07", "10"]
+
+# Aggregation engines producing the same sums
+ENGINES = ['pandas', 'arrow', 'duckdb']
+
+# Rough working-set size of one raw row in a batch, and of one accumulated tile
+BATCH_BYTES_PER_ROW = 256
+ACC_BYTES_PER_ROW = 48
 
 # Parser
 def parse_args():
@@ -10,11 +36,331 @@ def parse_args():
     parser.add_argument('--d_type', type=str, choices=['mobile', 'fixed'], default='fixed', help='Data type: mobile or fixed')
     parser.add_argument('--speed_data_path', type=str, required=True, help='Path to the speed raw data')
     parser.add_argument('--base_path', type=str, required=True, help='Base path for output data')
+    parser.add_argument('--pop_data_path', type=str, default=None, help='Population by quadkey (default: raw_data/pop_2020_quadkey_13.parquet.gz)')
+    parser.add_argument('--streaming', action='store_true', help='Read the tiles files one record batch at a time')
+    parser.add_argument('--memory_cap_mb', type=int, default=1024, help='Approximate memory budget for streaming mode (MB)')
+    parser.add_argument('--compression', type=str, choices=intermediate_io.COMPRESSIONS, default='zstd', help='Compression codec of the output')
+    parser.add_argument('--compression_level', type=int, default=None, help='Compression level of the output codec')
+    parser.add_argument('--engine', type=str, choices=ENGINES, default='pandas', help='Aggregation engine (arrow and duckdb work out of core over the raw files)')
+    parser.add_argument('--threads', type=int, default=None, help='Threads of the arrow/duckdb engine (default: all cores)')
+    parser.add_argument('--spill_dir', type=str, default=None, help='Spill directory of the duckdb engine (default: system temp directory)')
+    parser.add_argument('--pyramid', type=str, default=None, help='Comma-separated zoom levels (e.g. 16,13,11,9) to produce in one pass instead of --zoom_level')
+    instrumentation.add_arguments(parser, default_profile_stage='groupby')
     return parser.parse_args()
 
+def tiles_file(speed_data_path, year, q, d_type):
+    return os.path.join(speed_data_path, f"{year}-{q}-01_performance_{d_type}_tiles.parquet")
+
+def pop_file(base_path):
+    return f'{base_path}/raw_data/pop_2020_quadkey_13.parquet.gz'
+
+def pyramid_dir(base_path, d_type, year):
+    return f"{base_path}/data/internet_speed_{d_type}_{year}_by_quadkey_pyramid"
+
+# Running sum-of-(value x tests) accumulator keyed by zoom-level tile
+class TileSumAccumulator:
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.parts = []
+        self.n_rows = 0
+
+    def add(self, sums):
+        self.parts.append(sums)
+        self.n_rows += len(sums)
+        if self.n_rows > self.max_rows:
+            self.compact()
+
+    def compact(self):
+        if len(self.parts) > 1:
+            self.parts = [weighted_agg.sum_by_key(pd.concat(self.parts))]
+        self.n_rows = sum(len(part) for part in self.parts)
+        # Past max_rows distinct tiles the cap cannot be met: let it grow with the sums so that
+        # later batches do not re-sort everything seen so far
+        self.max_rows = max(self.max_rows, 2 * self.n_rows)
+
+    def result(self):
+        self.compact()
+        if not self.parts:
+            return pd.DataFrame(columns=SUM_COLUMNS, index=pd.Index([], name='quadkey_int', dtype='uint64'))
+        return self.parts[0]
+
+# Ensure numeric columns are correctly typed
+def coerce_tiles(tiles):
+    for col in SUM_COLUMNS:
+        tiles[col] = pd.to_numeric(tiles[col], errors='coerce')
+    return tiles
+
+# Sums of value x tests, tests and devices of raw tiles, keyed by the zoom-level tile
+def group_tile_sums(tiles, zoom_level):
+    # Encode quadkeys as integers and roll them up to the zoom level
+    keys = quadkey_int.parent(quadkey_int.encode(tiles['quadkey']), zoom_level)
+    sums = weighted_agg.weighted_sums(
+        keys,
+        {col: tiles[col].to_numpy() for col in WEIGHTED_COLUMNS},
+        {'tests': tiles['tests'].to_numpy()},
+        {'devices': tiles['devices'].to_numpy()},
+        key_name='quadkey_int',
+    )
+    return sums.rename(columns={f'{col}_x_tests': col for col in WEIGHTED_COLUMNS})[SUM_COLUMNS]
+
+# Test-weighted sums of one chunk of raw tiles, keyed by the zoom-level tile
+def tile_sums(tiles, zoom_level):
+    with stage('type_coercion', rows_in=len(tiles)):
+        coerce_tiles(tiles)
+
+    with stage('groupby', rows_in=len(tiles)) as record:
+        sums = group_tile_sums(tiles, zoom_level)
+        record['rows_out'] = len(sums)
+    return sums
+
+# Fold one tiles file into the accumulator, one record batch at a time.
+# Batches are not instrumented one by one: the caller measures the whole scan.
+def stream_tile_sums(tiles_path, zoom_level, batch_rows, accumulator):
+    parquet_file = pq.ParquetFile(tiles_path)
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=TILE_COLUMNS):
+        accumulator.add(group_tile_sums(coerce_tiles(batch.to_pandas()), zoom_level))
+
+# Test-weighted sums of several tiles files, folded one record batch at a time into a single
+# accumulator, so the running sums of all the files share one memory budget
+def stream_files_sums(tiles_paths, zoom_level, memory_cap_mb=1024):
+    # Split the memory budget between the record batch and the running sums
+    memory_cap = memory_cap_mb * 1024 * 1024
+    batch_rows = max(10_000, memory_cap // 4 // BATCH_BYTES_PER_ROW)
+    accumulator = TileSumAccumulator(max_rows=memory_cap // 2 // ACC_BYTES_PER_ROW)
+
+    # One stage for the whole scan: reading, grouping and compacting the batches
+    with stage('groupby', bytes_read=sum(os.path.getsize(path) for path in tiles_paths), streaming=True) as record:
+        record['rows_in'] = sum(pq.ParquetFile(path).metadata.num_rows for path in tiles_paths)
+        for tiles_path in tiles_paths:
+            stream_tile_sums(tiles_path, zoom_level, batch_rows, accumulator)
+        sums = accumulator.result()
+        record['rows_out'] = len(sums)
+    return sums
+
+# Test-weighted sums of one quarterly tiles file
+def read_quarter_sums(tiles_path, zoom_level):
+    with stage('parquet_read', bytes_read=os.path.getsize(tiles_path), path=tiles_path) as record:
+        tiles = pd.read_parquet(tiles_path)
+        record['rows_out'] = len(tiles)
+    return tile_sums(tiles, zoom_level)
+
+# Combine sums of several quarters (or shards) into one table of sums
+def combine_sums(sums_list):
+    sums_list = [sums for sums in sums_list if len(sums)]
+    if not sums_list:
+        return TileSumAccumulator(max_rows=0).result()
+    with stage('merge', rows_in=sum(len(sums) for sums in sums_list), step='combine_quarters') as record:
+        sums = weighted_agg.sum_by_key(pd.concat(sums_list))
+        record['rows_out'] = len(sums)
+    return sums
+
+# Test-weighted sums of prefix-grouped quadkeys, as the table combine_sums returns
+def prefix_sums_to_frame(quadkeys, columns):
+    sums = pd.DataFrame(columns, index=pd.Index(quadkey_int.encode(quadkeys), name='quadkey_int'))
+    return sums[SUM_COLUMNS].sort_index()
+
+# Arrow compute engine: the files are scanned batch by batch on Arrow's thread pool and the
+# per-batch sums are folded into running sums, so memory is bounded by the number of tiles
+def arrow_tile_sums(tiles_paths, zoom_level, memory_cap_mb=1024, threads=None):
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    if threads:
+        pa.set_cpu_count(threads)
+
+    memory_cap = memory_cap_mb * 1024 * 1024
+    batch_rows = max(10_000, memory_cap // 4 // BATCH_BYTES_PER_ROW)
+    max_rows = memory_cap // 2 // ACC_BYTES_PER_ROW
+    aggregations = [(col, 'sum') for col in SUM_COLUMNS]
+
+    def group_sums(table):
+        sums = table.group_by('quadkey').aggregate(aggregations)
+        return sums.rename_columns([name[:-len('_sum')] if name.endswith('_sum') else name for name in sums.column_names])
+
+    parts = []
+    n_rows = 0
+    dataset = ds.dataset(tiles_paths, format='parquet')
+    with stage('groupby', bytes_read=sum(os.path.getsize(path) for path in tiles_paths), engine='arrow') as record:
+        record['rows_in'] = dataset.count_rows()
+        for batch in dataset.to_batches(columns=TILE_COLUMNS, batch_size=batch_rows):
+            # The parent of a quadkey is its prefix, so tiles are grouped on the first zoom_level digits
+            columns = {'quadkey': pc.utf8_slice_codeunits(batch.column('quadkey'), 0, zoom_level)}
+            for col in WEIGHTED_COLUMNS:
+                columns[col] = pc.multiply(batch.column(col), batch.column('tests'))
+            columns['tests'] = batch.column('tests')
+            columns['devices'] = batch.column('devices')
+
+            part = group_sums(pa.table(columns))
+            parts.append(part)
+            n_rows += len(part)
+            if n_rows > max_rows and len(parts) > 1:
+                parts = [group_sums(pa.concat_tables(parts))]
+                n_rows = len(parts[0])
+                # Same growing threshold as TileSumAccumulator.compact
+                max_rows = max(max_rows, 2 * n_rows)
+
+        sums = group_sums(pa.concat_tables(parts)) if len(parts) > 1 else parts[0] if parts else None
+        record['rows_out'] = 0 if sums is None else len(sums)
+
+    if sums is None:
+        return TileSumAccumulator(max_rows=0).result()
+    return prefix_sums_to_frame(
+        sums.column('quadkey').to_numpy(zero_copy_only=False),
+        {col: sums.column(col).to_numpy(zero_copy_only=False) for col in SUM_COLUMNS},
+    )
+
+# DuckDB engine: one GROUP BY over all the files, multi-threaded and spilling to disk past memory_cap_mb
+def duckdb_tile_sums(tiles_paths, zoom_level, memory_cap_mb=1024, threads=None, spill_dir=None):
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError('--engine duckdb needs the duckdb package (pip install duckdb)') from None
+
+    if not tiles_paths:
+        return TileSumAccumulator(max_rows=0).result()
+
+    con = duckdb.connect()
+    con.execute(f"SET memory_limit = '{memory_cap_mb}MB'")
+    # SET takes no parameters, so quotes in the path are escaped for the SQL literal
+    spill_dir = (spill_dir or os.path.join(tempfile.gettempdir(), 'duckdb_spill')).replace("'", "''")
+    con.execute(f"SET temp_directory = '{spill_dir}'")
+    if threads:
+        con.execute(f'SET threads = {int(threads)}')
+
+    # Integer sums are cast back from HUGEINT so they match the int64 sums of pandas
+    schema = pq.read_schema(tiles_paths[0])
+    def total(expression, col):
+        if pa.types.is_integer(schema.field(col).type):
+            return f'CAST(SUM({expression}) AS BIGINT) AS {col}'
+        return f'SUM({expression}) AS {col}'
+
+    select = [total(f'{col} * tests', col) for col in WEIGHTED_COLUMNS] + [total(col, col) for col in ['tests', 'devices']]
+    query = f"""
+        SELECT left(quadkey, {int(zoom_level)}) AS quadkey, {', '.join(select)}
+        FROM read_parquet(?)
+        GROUP BY 1
+    """
+
+    with stage('groupby', bytes_read=sum(os.path.getsize(path) for path in tiles_paths), engine='duckdb') as record:
+        sums = con.execute(query, [list(tiles_paths)]).df()
+        record['rows_out'] = len(sums)
+    con.close()
+
+    return prefix_sums_to_frame(sums['quadkey'].to_numpy(), {col: sums[col].to_numpy() for col in SUM_COLUMNS})
+
+# Test-weighted sums of several tiles files (the quarters of a year) with the chosen engine
+def engine_tile_sums(tiles_paths, zoom_level, engine='pandas', streaming=False, memory_cap_mb=1024, threads=None, spill_dir=None):
+    if engine == 'arrow':
+        return arrow_tile_sums(tiles_paths, zoom_level, memory_cap_mb, threads)
+    if engine == 'duckdb':
+        return duckdb_tile_sums(tiles_paths, zoom_level, memory_cap_mb, threads, spill_dir)
+    if streaming:
+        return stream_files_sums(tiles_paths, zoom_level, memory_cap_mb)
+    return combine_sums([read_quarter_sums(path, zoom_level) for path in tiles_paths])
+
+# Roll sums up to a coarser zoom level (quadkey prefixes nest, so sums of children add up)
+def rollup_sums(sums, zoom_level):
+    parents = quadkey_int.parent(sums.index.to_numpy(), zoom_level)
+    return weighted_agg.sum_by_key(sums, parents, key_name='quadkey_int')
+
+# Sums at every level of a pyramid, each level built from the one below it
+def build_pyramid(sums, levels):
+    levels = sorted(levels, reverse=True)
+    pyramid = {levels[0]: sums}
+    for finer, coarser in zip(levels, levels[1:]):
+        pyramid[coarser] = rollup_sums(pyramid[finer], coarser)
+    return pyramid
+
+# Write the levels of a pyramid as one parquet dataset partitioned by zoom_level
+def write_pyramid(tables, path, compression='zstd', compression_level=None):
+    table = pa.concat_tables([
+        intermediate_io.to_intermediate_table(all_data).append_column('zoom_level', pa.array([level] * len(all_data), pa.uint8()))
+        for level, all_data in sorted(tables.items(), reverse=True)
+    ])
+    # Levels of an earlier run that this one does not write are removed, the others are replaced
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name.startswith('zoom_level=') and int(name.split('=', 1)[1]) not in tables:
+                shutil.rmtree(os.path.join(path, name))
+    pq.write_to_dataset(
+        table, path, partition_cols=['zoom_level'], existing_data_behavior='delete_matching',
+        compression=compression, compression_level=compression_level,
+        row_group_size=intermediate_io.ROW_GROUP_SIZE, write_statistics=True,
+    )
+
+# Turn test-weighted sums into averages, with the quadkey string and integer key as columns.
+# The additive sums are kept as *_x_tests columns so yearly tables can be merged exactly later on.
+def sums_to_averages(sums):
+    all_data = sums.reset_index()
+
+    # Keep the additive sums
+    for col in WEIGHTED_COLUMNS:
+        all_data[f'{col}_x_tests'] = all_data[col]
+
+    # Compute weighted averages
+    all_data['avg_d_kbps'] = all_data['avg_d_kbps'] / all_data['tests']
+    all_data['avg_u_kbps'] = all_data['avg_u_kbps'] / all_data['tests']
+    all_data['avg_lat_ms'] = all_data['avg_lat_ms'] / all_data['tests']
+
+    # Decode integer keys back to quadkey strings for the output
+    all_data.insert(0, 'quadkey', quadkey_int.decode(all_data['quadkey_int']))
+    return all_data
+
+# Population by tile, indexed by the sorted integer key
+def load_population(pop_data_path):
+    pop_data = pd.read_parquet(pop_data_path, engine='pyarrow')
+    pop_data['quadkey_int'] = quadkey_int.encode(pop_data.pop('quadkey'))
+    return pop_data.set_index('quadkey_int').sort_index()
+
+# Population summed up to a zoom level (None when the population data is coarser than that level)
+def population_at(pop_data, zoom_level):
+    pop_level = int(quadkey_int.level_of(pop_data.index[:1].to_numpy())[0]) if len(pop_data) else zoom_level
+    if zoom_level > pop_level:
+        print(f'Warning: population is only available down to zoom level {pop_level}, '
+              f'zoom level {zoom_level} gets no population')
+        return None
+    if zoom_level == pop_level:
+        return pop_data
+    return rollup_sums(pop_data, zoom_level)
+
+# Population of every pyramid level that the population data can provide, each built from the level below
+def population_pyramid(pop_data, levels):
+    pop_level = int(quadkey_int.level_of(pop_data.index[:1].to_numpy())[0]) if len(pop_data) else max(levels)
+    coarse_levels = [level for level in levels if level <= pop_level]
+    pyramid = build_pyramid(population_at(pop_data, max(coarse_levels)), coarse_levels) if coarse_levels else {}
+    for level in levels:
+        if level not in pyramid:
+            population_at(pop_data, level)  # warns about the missing level
+    return {level: pyramid.get(level) for level in levels}
+
+# Left join of population on the integer key, as a sorted merge; reports matched and unmatched tiles
+def join_population(all_data, pop_data):
+    keys = all_data['quadkey_int'].to_numpy(dtype=np.uint64)
+
+    if pop_data is None or len(pop_data) == 0:
+        all_data['pop_2020'] = np.nan
+        print(f'Population join: 0 of {len(keys)} tiles matched')
+        return all_data
+
+    with stage('merge', rows_in=len(keys), step='population') as record:
+        pop_keys = pop_data.index.to_numpy(dtype=np.uint64)
+        pos = np.minimum(np.searchsorted(pop_keys, keys), len(pop_keys) - 1)
+        matched = pop_keys[pos] == keys
+
+        for col in pop_data.columns:
+            values = np.full(len(keys), np.nan)
+            values[matched] = pop_data[col].to_numpy()[pos[matched]]
+            all_data[col] = values
+        record['rows_out'] = len(all_data)
+
+    print(f'Population join: {matched.sum()} of {len(keys)} tiles matched, {(~matched).sum()} without population, '
+          f'{len(pop_keys) - matched.sum()} populated tiles without speed data')
+    return all_data
+
 # Main function
 def main():
     args = parse_args()
+    instrumentation.configure_from_args(args)
 
     # Set parameters from command-line arguments
     year = args.year
@@ -22,95 +368,68 @@ def main():
     d_type = args.d_type
     speed_data_path = args.speed_data_path
     base_path = args.base_path
-    pop_data_path = f'{base_path}/raw_data/pop_2020_quadkey_13.parquet.gz'
+
+    # In pyramid mode the raw files are read once at the finest level
+    if args.pyramid:
+        levels = sorted({int(level) for level in args.pyramid.split(',')}, reverse=True)
+        zoom_level = levels[0]
 
     #----------------------------------#
     # READ AND AGGREGATE DATA AT ZOOM LEVEL
 
-    # Define the quarter indices in file paths
-    qs = ["01", "04", "07", "10"]
-
-    agg_funcs = {
-        'avg_d_kbps': 'sum',
-        'avg_u_kbps': 'sum',
-        'avg_lat_ms': 'sum',
-        'tests': 'sum',
-        'devices': 'sum'
-    }
-
-    # Initialize an empty DataFrame for all data
-    all_data_list = []
-
-    for q in qs:
-
-        tiles_path = os.path.join(speed_data_path, f"{year}-{q}-01_performance_{d_type}_tiles.parquet")
-                
-        # Read the Parquet file into a DataFrame
-        try:
-            tiles = pd.read_parquet(tiles_path)
-        
-            # Ensure numeric columns are correctly typed
-            tiles['avg_d_kbps'] = pd.to_numeric(tiles['avg_d_kbps'], errors='coerce')
-            tiles['avg_u_kbps'] = pd.to_numeric(tiles['avg_u_kbps'], errors='coerce')
-            tiles['avg_lat_ms'] = pd.to_numeric(tiles['avg_lat_ms'], errors='coerce')
-            tiles['tests'] = pd.to_numeric(tiles['tests'], errors='coerce')
-            tiles['devices'] = pd.to_numeric(tiles['devices'], errors='coerce')
-        
-            # Extract first x characters from quadkey
-            tiles['quadkey'] = tiles['quadkey'].str[:zoom_level]
-        
-            #Compute weighted columns
-            tiles['avg_d_kbps'] = tiles['avg_d_kbps'] * tiles['tests']
-            tiles['avg_u_kbps'] = tiles['avg_u_kbps'] * tiles['tests']
-            tiles['avg_lat_ms'] = tiles['avg_lat_ms'] * tiles['tests']
-
-            tiles = tiles.groupby('quadkey').agg(agg_funcs).reset_index()
-
-            # Compute weighted averages
-            tiles['avg_d_kbps'] = tiles['avg_d_kbps'] / tiles['tests']
-            tiles['avg_u_kbps'] = tiles['avg_u_kbps'] / tiles['tests']
-            tiles['avg_lat_ms'] = tiles['avg_lat_ms'] / tiles['tests']
-        
-            # Append to all_data
-            all_data_list.append(tiles)
-
-        except FileNotFoundError:
+    tiles_paths = []
+
+    for q in QUARTERS:
+
+        tiles_path = tiles_file(speed_data_path, year, q, d_type)
+
+        if os.path.exists(tiles_path):
+            tiles_paths.append(tiles_path)
+        else:
             print(f'File not found (skipped): {tiles_path}')
 
     #----------------------------------#
     # CONCAT DATA
 
-    all_data = pd.concat(all_data_list, ignore_index=True)
+    # Quarters are combined on their test-weighted sums, so they only need to be divided once
+    sums = engine_tile_sums(tiles_paths, zoom_level, args.engine, args.streaming, args.memory_cap_mb, args.threads, args.spill_dir)
+    pop_data = load_population(args.pop_data_path or pop_file(base_path))
 
-    # Compute weighted columns
-    all_data['avg_d_kbps'] = all_data['avg_d_kbps'] * all_data['tests']
-    all_data['avg_u_kbps'] = all_data['avg_u_kbps'] * all_data['tests']
-    all_data['avg_lat_ms'] = all_data['avg_lat_ms'] * all_data['tests']
+    if args.pyramid:
+        # Population is rolled up alongside the speed sums, each level from the level below
+        pop_levels = population_pyramid(pop_data, levels)
+        tables = {
+            level: join_population(sums_to_averages(level_sums), pop_levels[level])
+            for level, level_sums in build_pyramid(sums, levels).items()
+        }
 
-    all_data = all_data.groupby('quadkey').agg(agg_funcs).reset_index()
+        output_path = pyramid_dir(base_path, d_type, year)
+        with stage('export', rows_in=sum(len(table) for table in tables.values()), path=output_path):
+            write_pyramid(tables, output_path, args.compression, args.compression_level)
+        all_data = tables[zoom_level]
 
-    # Compute weighted averages
-    all_data['avg_d_kbps'] = all_data['avg_d_kbps'] / all_data['tests']
-    all_data['avg_u_kbps'] = all_data['avg_u_kbps'] / all_data['tests']
-    all_data['avg_lat_ms'] = all_data['avg_lat_ms'] / all_data['tests']
+    else:
+        all_data = sums_to_averages(sums)
 
+        #----------------------------------#
+        # APPEND POPULATION DATA
 
-    #----------------------------------#
-    # APPEND POPULATION DATA
+        all_data = join_population(all_data, population_at(pop_data, zoom_level))
 
-    pop_data = pd.read_parquet(pop_data_path, engine='pyarrow')
-    all_data = pd.merge(all_data, pop_data, on='quadkey', how='left')
+        #----------------------------------#
+        # EXPORT
 
-    #----------------------------------#
-    # EXPORT
-                    
-    # Export all_data as a Parquet file
-    output_file = f"{base_path}/data/internet_speed_{d_type}_{year}_by_quadkey_{zoom_level}.parquet.gz"
-    all_data.to_parquet(output_file, index=False, compression='gzip')
+        # Export all_data as a typed Parquet file sorted by quadkey
+        output_path = intermediate_io.yearly_file(base_path, d_type, year, zoom_level, args.compression)
+        with stage('export', rows_in=len(all_data), path=output_path):
+            intermediate_io.write_intermediate(all_data, output_path, args.compression, args.compression_level)
 
     # Display the first few rows of the annual average data
-    print(f"Data exported to {output_file}. \nHead: \n")
+    print(f"Data exported to {output_path}. \nHead: \n")
     print(all_data.head())
 
+    if args.streaming:
+        print(f"Peak RSS: {instrumentation.peak_rss_mb():.1f} MB")
+
 if __name__ == '__main__':
     main()
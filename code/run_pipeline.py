@@ -0,0 +1,240 @@
+import argparse
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+import pandas as pd
+
+import create_summary_file
+import fetch_ookla
+import instrumentation
+import intermediate_io
+import manifest
+import read_and_group_ookla as rg
+
+# Pipeline driver
+#
+# Aggregates every (year, quarter, type) raw file on a process pool, combines
+# the quarters of each year/type on their test-weighted sums, joins the
+# population table (loaded once, in this process) and passes the tables
+# straight to the country summary without a round trip through gzip parquet.
+# With --fetch the raw files are downloaded by fetch_ookla.py in the same run,
+# and each quarter is aggregated as soon as its file is on disk.
+
+# Rough peak memory of aggregating one raw file in memory, per byte of parquet on disk
+MEMORY_PER_FILE_BYTE = 6
+
+# Parser
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the Ookla aggregation and country summary in parallel.')
+    parser.add_argument('--years', type=str, default='2019,2020,2021,2022,2023,2024', help='Comma-separated list of years')
+    parser.add_argument('--types', type=str, default='mobile,fixed', help='Comma-separated list of internet types')
+    parser.add_argument('--zoom_level', type=int, default=13, help='Zoom level of the data')
+    parser.add_argument('--speed_data_path', type=str, required=True, help='Path to the speed raw data')
+    parser.add_argument('--base_path', type=str, required=True, help='Base path for input and output data')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--memory_cap_mb', type=int, default=16384, help='Memory budget shared by all running jobs (MB)')
+    parser.add_argument('--streaming', action='store_true', help='Aggregate each file one record batch at a time')
+    parser.add_argument('--write_intermediate', action='store_true', help='Also write the yearly by_quadkey parquet files')
+    parser.add_argument('--compression', type=str, choices=intermediate_io.COMPRESSIONS, default='zstd', help='Compression codec of the yearly files')
+    parser.add_argument('--compression_level', type=int, default=None, help='Compression level of the yearly files')
+    parser.add_argument('--incremental', action='store_true', help='Only reprocess quarters whose raw files changed since the last run')
+    parser.add_argument('--engine', type=str, choices=rg.ENGINES, default='pandas', help='Aggregation engine of the quarter jobs')
+    parser.add_argument('--threads', type=int, default=None, help='Threads per quarter job of the arrow/duckdb engine (default: cores / workers)')
+    parser.add_argument('--spill_dir', type=str, default=None, help='Spill directory of the duckdb engine (default: system temp directory)')
+    parser.add_argument('--distribution', action='store_true', help='Also report weighted quantiles of tile speeds and a bootstrap interval of avg_d_mbps_w')
+    parser.add_argument('--fetch', action='store_true', help='Download the raw files while aggregating them')
+    parser.add_argument('--endpoint_url', type=str, default=fetch_ookla.DEFAULT_ENDPOINT, help='Bucket URL of the raw files (https://, http:// or file://)')
+    parser.add_argument('--fetch_workers', type=int, default=8, help='Number of concurrent downloads')
+    instrumentation.add_arguments(parser, default_profile_stage='groupby')
+    return parser.parse_args()
+
+# Estimated peak memory of one quarter job (MB)
+def job_memory_mb(tiles_path, streaming, memory_cap_mb):
+    if streaming:
+        return memory_cap_mb
+    return os.path.getsize(tiles_path) * MEMORY_PER_FILE_BYTE / 1024 / 1024
+
+def quarter_job(tiles_path, zoom_level, streaming, memory_cap_mb, engine='pandas', threads=None, spill_dir=None):
+    return rg.engine_tile_sums([tiles_path], zoom_level, engine, streaming, memory_cap_mb, threads, spill_dir)
+
+# Run the quarter jobs, never starting one that would take the estimated memory use above the cap.
+# `downloads` maps download futures (see fetch_ookla.Fetcher) to their (year, quarter, type);
+# each job is queued as soon as its file is downloaded.
+def run_quarter_jobs(jobs, zoom_level, workers, memory_cap_mb, streaming, engine='pandas', threads=None, spill_dir=None, downloads=None):
+    results = {}
+    downloads = dict(downloads or {})
+    # The arrow/duckdb engines are multi-threaded, share the cores between the workers
+    threads = threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+    # In streaming mode each job gets an equal share of the memory cap
+    job_cap_mb = max(64, memory_cap_mb // max(1, workers))
+    pending = sorted(jobs, key=lambda job: -job_memory_mb(job[-1], streaming, job_cap_mb))
+
+    # Workers log and profile their stages with the driver's settings
+    with ProcessPoolExecutor(max_workers=workers, initializer=partial(instrumentation.configure, **instrumentation.config())) as pool:
+        running = {}
+        while pending or running or downloads:
+            in_use = sum(mem for _, mem in running.values())
+            for job in list(pending):
+                mem = job_memory_mb(job[-1], streaming, job_cap_mb)
+                if len(running) >= workers or (running and in_use + mem > memory_cap_mb):
+                    continue
+                future = pool.submit(quarter_job, job[-1], zoom_level, streaming, job_cap_mb, engine, threads, spill_dir)
+                running[future] = (job, mem)
+                in_use += mem
+                pending.remove(job)
+
+            done, _ = wait(list(running) + list(downloads), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    job = downloads.pop(future)
+                    tiles_path = future.result()
+                    if tiles_path is None:
+                        print(f'Not available (skipped): {fetch_ookla.object_key(*job)}')
+                        continue
+                    pending.append(job + (tiles_path,))
+                    pending.sort(key=lambda job: -job_memory_mb(job[-1], streaming, job_cap_mb))
+                    continue
+                job, _ = running.pop(future)
+                results[job[:3]] = future.result()
+                print(f'Aggregated {job[-1]} (peak RSS of driver: {instrumentation.peak_rss_mb():.1f} MB)')
+
+    return results
+
+# Split jobs into quarters to (re)aggregate and quarters whose stored sums are still valid.
+# Returns the jobs to run (with their fingerprints), the cached intermediates and the (year, type) groups that changed.
+def plan_incremental(jobs, manifest_data, run_years, run_types, zoom_level, speed_data_path, base_path):
+    to_run = {}
+    cached = {}
+    changed_groups = set()
+
+    for job in jobs:
+        year, q, d_type, tiles_path = job
+        intermediate_path = manifest.quarter_sums_file(base_path, d_type, year, q, zoom_level)
+        changed, current = manifest.needs_update(manifest_data, tiles_path, intermediate_path)
+        if changed:
+            to_run[job] = current
+            changed_groups.add((year, d_type))
+        else:
+            cached[(year, q, d_type)] = intermediate_path
+            # Refresh size/mtime so unchanged files are not hashed again next time
+            manifest.record(manifest_data, tiles_path, current, intermediate_path)
+
+    # Raw files that disappeared since the last run also change their year
+    for year in run_years:
+        for d_type in run_types:
+            for q in rg.QUARTERS:
+                tiles_path = rg.tiles_file(speed_data_path, year, q, d_type)
+                if os.path.basename(tiles_path) in manifest_data and not os.path.exists(tiles_path):
+                    del manifest_data[os.path.basename(tiles_path)]
+                    changed_groups.add((year, d_type))
+
+    return to_run, cached, changed_groups
+
+# Store the sums of freshly aggregated quarters and record them in the manifest
+def store_quarter_sums(results, to_run, manifest_data, zoom_level, base_path):
+    for (year, q, d_type, tiles_path), current in to_run.items():
+        intermediate_path = manifest.quarter_sums_file(base_path, d_type, year, q, zoom_level)
+        os.makedirs(os.path.dirname(intermediate_path), exist_ok=True)
+        results[(year, q, d_type)].to_parquet(intermediate_path)
+        manifest.record(manifest_data, tiles_path, current, intermediate_path)
+
+# Yield (year, type, tile table) items in the order of `groups`, ready for the country summary
+def yearly_tables(results, groups, zoom_level, base_path, write_intermediate, compression='zstd', compression_level=None):
+    # Load the population table once for all years and types
+    pop_data = rg.population_at(rg.load_population(rg.pop_file(base_path)), zoom_level)
+
+    for year, d_type in groups:
+        sums = [results[(year, q, d_type)] for q in rg.QUARTERS if (year, q, d_type) in results]
+        all_data = rg.join_population(rg.sums_to_averages(rg.combine_sums(sums)), pop_data)
+
+        if write_intermediate:
+            output_path = intermediate_io.yearly_file(base_path, d_type, year, zoom_level, compression)
+            intermediate_io.write_intermediate(all_data, output_path, compression, compression_level)
+
+        yield year, d_type, all_data
+
+def main():
+    args = parse_args()
+    instrumentation.configure_from_args(args)
+    run_years = [int(year) for year in args.years.split(',')]
+    run_types = args.types.split(',')
+
+    start = time.perf_counter()
+
+    #----------------------------------#
+    # AGGREGATE RAW DATA
+
+    jobs = []
+    downloads = {}
+    if args.fetch:
+        fetcher = fetch_ookla.Fetcher(args.endpoint_url, args.speed_data_path, args.fetch_workers)
+        downloads = {
+            fetcher.submit(year, q, d_type): (year, q, d_type)
+            for year in run_years for d_type in run_types for q in rg.QUARTERS
+        }
+        # Incremental runs compare the raw files with the manifest first, so they wait for the downloads
+        if args.incremental:
+            for future, job in downloads.items():
+                if future.result() is not None:
+                    jobs.append(job + (future.result(),))
+            downloads = {}
+    else:
+        for year in run_years:
+            for d_type in run_types:
+                for q in rg.QUARTERS:
+                    tiles_path = rg.tiles_file(args.speed_data_path, year, q, d_type)
+                    if os.path.exists(tiles_path):
+                        jobs.append((year, q, d_type, tiles_path))
+                    else:
+                        print(f'File not found (skipped): {tiles_path}')
+
+    summary_path = create_summary_file.summary_file(args.base_path)
+    groups = [(year, d_type) for year in run_years for d_type in run_types]
+
+    if args.incremental:
+        manifest_path = manifest.manifest_file(args.base_path)
+        manifest_data = manifest.load_manifest(manifest_path)
+        to_run, cached, changed_groups = plan_incremental(
+            jobs, manifest_data, run_years, run_types, args.zoom_level, args.speed_data_path, args.base_path)
+        print(f'{len(to_run)} of {len(jobs)} quarter files are new or changed')
+
+        results = run_quarter_jobs(list(to_run), args.zoom_level, args.workers, args.memory_cap_mb, args.streaming,
+                                   args.engine, args.threads, args.spill_dir)
+        store_quarter_sums(results, to_run, manifest_data, args.zoom_level, args.base_path)
+        manifest.save_manifest(manifest_data, manifest_path)
+
+        # Without a previous summary every year and type has to be summarised
+        if os.path.exists(summary_path):
+            groups = [group for group in groups if group in changed_groups]
+
+        # Unchanged quarters of the groups to summarise are merged back from their stored sums
+        for key, intermediate_path in cached.items():
+            if (key[0], key[2]) in groups:
+                results[key] = pd.read_parquet(intermediate_path)
+    else:
+        results = run_quarter_jobs(jobs, args.zoom_level, args.workers, args.memory_cap_mb, args.streaming,
+                                   args.engine, args.threads, args.spill_dir, downloads)
+
+    if args.fetch:
+        fetcher.close()
+
+    #----------------------------------#
+    # SUMMARISE BY COUNTRY
+
+    if not groups:
+        print('No raw file changed, the summary is up to date')
+        return
+
+    items = yearly_tables(results, groups, args.zoom_level, args.base_path, args.write_intermediate,
+                          args.compression, args.compression_level)
+    concat_data = create_summary_file.summarise_all(items, args.base_path, args.distribution)
+    concat_data = create_summary_file.update_summary(summary_path, concat_data)
+    with instrumentation.stage('export', rows_in=len(concat_data), path=summary_path):
+        create_summary_file.write_summary(concat_data, args.base_path)
+
+    print(f'Pipeline finished in {time.perf_counter() - start:.1f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Precomputed summary cube for the notebook and the Shiny app
+#
+# The widgets of notebooks/sp_vis_functions.py and app.R show one (region,
+# year, type) slice of the country summary at a time. Everything they derive
+# from a slice is computed here once, when the summary is written:
+#   rankings.csv    one row per (region, year, type, country) with k_tests >= 1,
+#                   ranks (average ties for the notebook, first-come ties for
+#                   the app), rank changes against the previous year and tests
+#                   per 1,000 people; 'World' holds every country
+#   bin_cutoffs.csv percentile map bins of each slice ('deciles' for the
+#                   notebook maps, 'app' for the quantiles of the Shiny map)
+#   countries.gpkg  simplified country polygons with their region, one layer per
+#                   map view: 'world' (coarse) and 'region' (finer)
+# Rows are sorted by (region, year, d_type) and rank, so a slice is a contiguous block.
+
+WORLD = 'World'
+CUBE_KEYS = ['region', 'year', 'd_type']
+RANKED_COLUMNS = ['avg_d_mbps', 'avg_d_mbps_w']
+
+# Percentiles of the map bins
+DECILES = np.linspace(0, 100, 11)
+APP_PERCENTILES = [0, 10, 20, 40, 60, 70, 80, 90, 95, 100]
+
+# Tolerance of the simplified polygons of each map view, in degrees (0.01 is about 1 km at the equator)
+SIMPLIFY_TOLERANCES = {'world': 0.05, 'region': 0.01}
+
+RANKINGS_FILE = 'rankings.csv'
+BIN_CUTOFFS_FILE = 'bin_cutoffs.csv'
+COUNTRIES_FILE = 'countries.gpkg'
+
+
+def cube_dir(base_path):
+    return f'{base_path}/summary_data/summary_cube'
+
+
+# Every row once under its own region and once under 'World'
+def with_regions(data):
+    regional = data[data['REGION_WB'].notna()]
+    return pd.concat([data.assign(region=WORLD), regional.assign(region=regional['REGION_WB'])], ignore_index=True)
+
+
+def _summary_rows(summary):
+    summary = summary.reset_index() if 'Country' not in summary.columns else summary
+    return summary[summary['k_tests'] >= 1]
+
+
+# Ranked rows of every (region, year, type) slice, as the table widgets show them
+def build_rankings(summary, countries):
+    countries = countries.drop_duplicates('Country')[['Country', 'REGION_WB', 'POP_EST']].reset_index(drop=True)
+    countries['order'] = np.arange(len(countries))
+    data = with_regions(_summary_rows(summary).merge(countries, on='Country', how='inner'))
+
+    # Slices sorted by speed, ties kept in shapefile order as the app's first-come ranks expect
+    data = data.sort_values(CUBE_KEYS + ['avg_d_mbps', 'order'], ascending=[True, True, True, False, True], kind='stable')
+    groups = data.groupby(CUBE_KEYS, sort=False)
+    for col in RANKED_COLUMNS:
+        data[f'rank_{col}'] = groups[col].rank(ascending=False)
+        data[f'rank_first_{col}'] = groups[col].rank(ascending=False, method='first', na_option='bottom').astype(int)
+
+    # Rank change against the same slice of the previous year (0 when the country was not ranked)
+    rank_columns = [f'rank_{col}' for col in RANKED_COLUMNS]
+    last = data[CUBE_KEYS + ['Country'] + rank_columns].assign(year=data['year'] + 1)
+    data = data.merge(last, on=CUBE_KEYS + ['Country'], how='left', suffixes=('', '_last'))
+    for col in RANKED_COLUMNS:
+        data[f'rank_change_{col}'] = (data[f'rank_{col}_last'] - data[f'rank_{col}']).fillna(0).astype(int)
+
+    # Change of rank once weighted by population, and tests per 1,000 people
+    data['rank_var'] = data['rank_first_avg_d_mbps_w'] - data['rank_first_avg_d_mbps']
+    data['tests_per_1000'] = round(1000 * data['k_tests'] / (data['POP_EST'] / 1000), 1)
+
+    data = data.drop(columns=['order', 'POP_EST'] + [f'{col}_last' for col in rank_columns])
+    return data[CUBE_KEYS + [col for col in data.columns if col not in CUBE_KEYS]].reset_index(drop=True)
+
+
+# Map bin cutoffs of every (region, year, type) slice, over the country polygons with data
+def build_bin_cutoffs(summary, countries):
+    data = with_regions(countries[['Country', 'REGION_WB']].merge(_summary_rows(summary), on='Country', how='inner'))
+
+    rows = []
+    for (region, year, d_type), group in data.groupby(CUBE_KEYS):
+        for variable in RANKED_COLUMNS:
+            values = group[variable].dropna().to_numpy()
+            if len(values) == 0:
+                continue
+            schemes = {
+                'deciles': np.unique(np.percentile(values, DECILES)),
+                'app': np.percentile(values, APP_PERCENTILES),
+            }
+            for scheme, cutoffs in schemes.items():
+                rows += [
+                    {'region': region, 'year': year, 'd_type': d_type, 'variable': variable,
+                     'scheme': scheme, 'bin': i, 'cutoff': cutoff}
+                    for i, cutoff in enumerate(cutoffs)
+                ]
+    return pd.DataFrame(rows, columns=CUBE_KEYS + ['variable', 'scheme', 'bin', 'cutoff'])
+
+
+# Simplify polygons without opening gaps or overlaps between neighbours.
+# Shared borders are simplified once when the polygons form a valid coverage (shapely 2.1+),
+# otherwise each polygon is simplified on its own, keeping it valid.
+def simplify_coverage(geometry, tolerance):
+    values = geometry.values
+    if hasattr(shapely, 'coverage_simplify') and shapely.coverage_is_valid(values):
+        return gpd.GeoSeries(shapely.coverage_simplify(values, tolerance), index=geometry.index, crs=geometry.crs)
+    return geometry.simplify(tolerance, preserve_topology=True)
+
+
+# Country polygons of every map view, simplified with the tolerance of that view
+def simplify_countries(gdf, tolerances=SIMPLIFY_TOLERANCES):
+    countries = gdf[['Country', 'REGION_WB', 'POP_EST', 'geometry']]
+    return {
+        view: countries.set_geometry(simplify_coverage(countries.geometry, tolerance))
+        for view, tolerance in tolerances.items()
+    }
+
+
+def write_cube(summary, gdf, path):
+    os.makedirs(path, exist_ok=True)
+    build_rankings(summary, gdf).to_csv(os.path.join(path, RANKINGS_FILE), index=False)
+    build_bin_cutoffs(summary, gdf).to_csv(os.path.join(path, BIN_CUTOFFS_FILE), index=False)
+
+    countries_path = os.path.join(path, COUNTRIES_FILE)
+    if os.path.exists(countries_path):
+        os.remove(countries_path)
+    for view, countries in simplify_countries(gdf).items():
+        countries.to_file(countries_path, layer=view, driver='GPKG')
@@ -0,0 +1,117 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from shapely.geometry import box
+
+import quadkey_int
+
+# Synthetic, Ookla-shaped inputs for benchmarks
+#
+# Tiles are zoom-16 quadkeys clustered around "cities" whose sizes follow a
+# Pareto law, with heavy-tailed test counts and log-normal speeds, written
+# in row groups so tens of millions of rows never have to sit in memory.
+
+RAW_ZOOM_LEVEL = 16
+
+
+def _city_centres(n_cities, rng):
+    lat = rng.uniform(-55, 70, n_cities)
+    lon = rng.uniform(-180, 180, n_cities)
+    x = ((lon + 180) / 360 * (1 << RAW_ZOOM_LEVEL)).astype(np.int64)
+    sin_lat = np.sin(np.radians(lat))
+    y = ((0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * (1 << RAW_ZOOM_LEVEL)).astype(np.int64)
+    size = rng.pareto(1.2, n_cities) + 1
+    return x, y, size / size.sum()
+
+
+def synthetic_tiles(n_rows, seed=0, n_cities=2000):
+    rng = np.random.default_rng(seed)
+    cx, cy, weight = _city_centres(n_cities, np.random.default_rng(1234))
+    city = rng.choice(n_cities, size=n_rows, p=weight)
+
+    # Tiles spread around their city centre, denser in the middle
+    spread = 5 + 40 * np.sqrt(weight[city] * n_cities)
+    max_tile = (1 << RAW_ZOOM_LEVEL) - 1
+    x = np.clip(cx[city] + rng.normal(0, spread).astype(np.int64), 0, max_tile)
+    y = np.clip(cy[city] + rng.normal(0, spread).astype(np.int64), 0, max_tile)
+    keys = quadkey_int.from_tile_xy(x, y, RAW_ZOOM_LEVEL)
+
+    tests = np.minimum(rng.geometric(0.15, n_rows), 5000)
+    city_speed = np.random.default_rng(99).lognormal(10.5, 0.8, n_cities)
+    return pd.DataFrame({
+        'quadkey': quadkey_int.decode(keys),
+        'tile': [f'POLYGON(({i}))' for i in range(n_rows)],
+        'avg_d_kbps': (city_speed[city] * rng.lognormal(0, 0.5, n_rows)).astype(np.int64),
+        'avg_u_kbps': (city_speed[city] / 4 * rng.lognormal(0, 0.5, n_rows)).astype(np.int64),
+        'avg_lat_ms': rng.lognormal(3.3, 0.5, n_rows).astype(np.int64),
+        'tests': tests,
+        'devices': np.maximum(1, (tests * rng.uniform(0.3, 1, n_rows)).astype(np.int64)),
+    })
+
+
+# Write a raw tiles file of n_rows rows in chunks
+def write_synthetic_tiles(path, n_rows, seed=0, chunk_rows=1_000_000):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    writer = None
+    for i, start in enumerate(range(0, n_rows, chunk_rows)):
+        table = pa.Table.from_pandas(synthetic_tiles(min(chunk_rows, n_rows - start), seed * 1000 + i), preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+# Population at zoom 13 for every tile under the synthetic cities
+def synthetic_population(zoom_level=13, n_rows=2_000_000, seed=0):
+    tiles = synthetic_tiles(n_rows, seed=seed)
+    keys = np.unique(quadkey_int.parent(quadkey_int.encode(tiles['quadkey']), zoom_level))
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'quadkey': quadkey_int.decode(keys), 'pop_2020': rng.lognormal(5, 2, len(keys))})
+
+
+# Grid of rectangular "countries" with the columns of the World Bank layer
+def synthetic_countries(n_lon=24, n_lat=12):
+    rows = []
+    lon_step = 360 / n_lon
+    lat_step = 170 / n_lat
+    for i in range(n_lon):
+        for j in range(n_lat):
+            n = i * n_lat + j
+            rows.append({
+                'POP_EST': 1e6 * (n + 1),
+                'GDP_MD_EST': 1e3 * (n + 1),
+                'ISO_N3': n + 1,
+                'WB_A3': f'C{n:03d}',
+                'REGION_WB': f'Region {i * 6 // n_lon}',
+                'Country': f'Country {n:03d}',
+                'geometry': box(-180 + i * lon_step, -85 + j * lat_step, -180 + (i + 1) * lon_step, -85 + (j + 1) * lat_step),
+            })
+    return gpd.GeoDataFrame(rows, crs=4326)
+
+
+# Yearly by_quadkey table with the columns and value ranges of the real one
+def synthetic_yearly_table(n_rows, zoom_level=13, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.integers(0, 1 << zoom_level, n_rows)
+    y = rng.integers(0, 1 << zoom_level, n_rows)
+    keys = np.unique(quadkey_int.from_tile_xy(x, y, zoom_level))
+
+    tests = rng.integers(1, 500, len(keys))
+    all_data = pd.DataFrame({
+        'quadkey': quadkey_int.decode(keys),
+        'quadkey_int': keys,
+        'avg_d_kbps': rng.lognormal(10, 1, len(keys)),
+        'avg_u_kbps': rng.lognormal(9, 1, len(keys)),
+        'avg_lat_ms': rng.lognormal(3, 0.5, len(keys)),
+        'tests': tests,
+        'devices': np.maximum(1, tests // 3),
+    })
+    for col in ['avg_d_kbps', 'avg_u_kbps', 'avg_lat_ms']:
+        all_data[f'{col}_x_tests'] = all_data[col] * all_data['tests']
+    all_data['pop_2020'] = rng.lognormal(5, 2, len(keys))
+    return all_data
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+# Group-by kernels shared by the aggregation and summary stages
+#
+# Groups are found with one stable sort of the keys and every column is then
+# reduced with np.add.reduceat over the sorted rows, so no intermediate
+# DataFrame is built and integer sums stay exact integers. Weighted sums are
+# named `{value}_x_{weight}` next to the weight totals `{weight}`; they are
+# additive, so tables of sums can be merged later and divided only once.
+# weighted_average also returns the means as `{value}_w_{weight}`.
+
+
+# Row order grouping equal keys, start of each group in that order and the sorted unique keys.
+# Null keys form no group, as in pandas groupby.
+def group_rows(keys):
+    keys = np.asarray(keys)
+    if keys.dtype.kind in 'iu':
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+    else:
+        codes, _ = pd.factorize(keys, sort=True)
+        order = np.argsort(codes, kind='stable')
+        order = order[codes[order] >= 0]
+        sorted_keys = codes[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(order) else np.array([], dtype=np.int64)
+    return order, starts, keys[order[starts]]
+
+
+# Sum of each group of already sorted values; NaN counts as 0, as in groupby sum
+def _group_total(sorted_values, starts):
+    if sorted_values.dtype.kind == 'f':
+        sorted_values = np.where(np.isnan(sorted_values), 0, sorted_values)
+    if len(starts) == 0:
+        return sorted_values[:0]
+    return np.add.reduceat(sorted_values, starts)
+
+
+# Sums of the columns of a frame by its index, or by `keys` (one value per row)
+def sum_by_key(frame, keys=None, key_name=None):
+    keys = frame.index.to_numpy() if keys is None else keys
+    order, starts, unique_keys = group_rows(keys)
+    return pd.DataFrame(
+        {col: _group_total(frame[col].to_numpy()[order], starts) for col in frame.columns},
+        index=pd.Index(unique_keys, name=key_name or frame.index.name),
+    )
+
+
+# Weight totals, value x weight sums for every (value, weight) pair and plain sums, by key.
+# `values`, `weights` and `sums` map column names to arrays of one value per row.
+def weighted_sums(keys, values, weights, sums=None, key_name=None):
+    order, starts, unique_keys = group_rows(keys)
+    sorted_values = {name: np.asarray(value)[order] for name, value in values.items()}
+
+    columns = {}
+    for weight_name, weight in weights.items():
+        sorted_weight = np.asarray(weight)[order]
+        columns[weight_name] = _group_total(sorted_weight, starts)
+        for value_name, sorted_value in sorted_values.items():
+            columns[f'{value_name}_x_{weight_name}'] = _group_total(sorted_value * sorted_weight, starts)
+    for name, value in (sums or {}).items():
+        columns[name] = _group_total(np.asarray(value)[order], starts)
+
+    return pd.DataFrame(columns, index=pd.Index(unique_keys, name=key_name))
+
+
+# Weighted means of every (value, weight) pair next to the additive sums they come from
+def weighted_average(keys, values, weights, sums=None, key_name=None):
+    result = weighted_sums(keys, values, weights, sums, key_name)
+    for weight_name in weights:
+        for value_name in values:
+            result[f'{value_name}_w_{weight_name}'] = result[f'{value_name}_x_{weight_name}'] / result[weight_name]
+    return result
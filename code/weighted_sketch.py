@@ -0,0 +1,143 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import weighted_agg
+
+# Mergeable weighted-quantile sketches and bootstrap sums
+#
+# QuantileSketch is a merging t-digest kept for many groups at once: every
+# group is a short list of centroids (mean, weight) sorted by mean. Values are
+# added in batches; each batch is sorted on its own and merged with the
+# centroids, which are then compressed so that a centroid spans at most one
+# unit of the arcsine scale k(q) = compression * (asin(2q - 1) / pi + 1/2).
+# Centroids stay small near the tails, so p10 and p90 are as accurate as the
+# median. Groups of fewer than `exact_rows` centroids are not compressed, so a
+# country with few tiles keeps every tile and its quantiles are the exact
+# weighted quantiles; larger groups never hold more than about `compression`
+# centroids once compressed, however many tiles they have. Sketches of
+# different batches, quarters or shards merge into the sketch of their union.
+#
+# The bootstrap of weighted means uses Poisson resampling: in replicate b
+# every tile is drawn Poisson(1) times, so the replicate sums of weight and
+# value x weight are additive over batches and shards as well.
+
+COMPRESSION = 200
+# Groups of fewer centroids than this are kept exact
+EXACT_ROWS = COMPRESSION * 5
+BATCH_ROWS = 128 * 1024
+REPLICATES = 200
+
+# Rows per batch of the bootstrap, which holds a (rows, replicates) array of draws
+BOOTSTRAP_BATCH_ROWS = 16 * 1024
+
+# Cumulative Poisson(1) probabilities, to draw counts from uniforms (counts above 12 have probability < 1e-10)
+POISSON_CDF = np.cumsum([np.exp(-1) / np.prod(np.arange(1, k + 1)) for k in range(13)]).astype(np.float32)
+
+
+class QuantileSketch:
+    def __init__(self, compression=COMPRESSION, exact_rows=EXACT_ROWS):
+        self.compression = compression
+        self.exact_rows = exact_rows
+        self.group = np.array([], dtype=np.int64)
+        self.mean = np.array([], dtype=np.float64)
+        self.weight = np.array([], dtype=np.float64)
+
+    # Add values with their weights to the integer groups `groups` (NaN values and non-positive weights are ignored)
+    def add(self, groups, values, weights):
+        groups = np.asarray(groups, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        for start in range(0, len(groups), BATCH_ROWS):
+            batch = slice(start, start + BATCH_ROWS)
+            keep = ~np.isnan(values[batch]) & (weights[batch] > 0)
+            self._merge(groups[batch][keep], values[batch][keep], weights[batch][keep])
+        return self
+
+    def merge(self, other):
+        self._merge(other.group, other.mean, other.weight)
+        return self
+
+    def _merge(self, group, mean, weight):
+        group = np.concatenate([self.group, group])
+        mean = np.concatenate([self.mean, mean])
+        weight = np.concatenate([self.weight, weight])
+        order = np.lexsort((mean, group))
+        group, mean, weight = group[order], mean[order], weight[order]
+        if len(group) == 0:
+            return
+
+        # Position of each centroid in its group, as the quantile of its midpoint
+        starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        sizes = np.diff(np.r_[starts, len(group)])
+        cumulative = np.cumsum(weight)
+        before_group = np.repeat(cumulative[starts] - weight[starts], sizes)
+        total = np.repeat(np.add.reduceat(weight, starts), sizes)
+        q = (cumulative - before_group - weight / 2) / total
+
+        # Merge the neighbours that share a unit of the k scale; rows of small groups each get their own unit
+        k = np.floor(self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5))
+        k = np.where(np.repeat(sizes < self.exact_rows, sizes), -1 - np.arange(len(k)), k)
+        bounds = np.flatnonzero(np.r_[True, (group[1:] != group[:-1]) | (k[1:] != k[:-1])])
+        self.weight = np.add.reduceat(weight, bounds)
+        self.mean = np.add.reduceat(mean * weight, bounds) / self.weight
+        self.group = group[bounds]
+
+    # Weighted quantiles of each group, interpolated between centroid midpoints; one column per quantile
+    def quantiles(self, qs):
+        starts = np.flatnonzero(np.r_[True, self.group[1:] != self.group[:-1]]) if len(self.group) else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], len(self.group)]
+
+        rows = []
+        for start, end in zip(starts, ends):
+            weight, mean = self.weight[start:end], self.mean[start:end]
+            midpoints = np.cumsum(weight) - weight / 2
+            rows.append(np.interp(np.asarray(qs) * weight.sum(), midpoints, mean))
+        return pd.DataFrame(np.reshape(rows, (len(starts), len(qs))), index=self.group[starts], columns=list(qs))
+
+    def to_frame(self):
+        return pd.DataFrame({'group': self.group, 'mean': self.mean, 'weight': self.weight})
+
+    @classmethod
+    def from_frame(cls, frame, compression=COMPRESSION, exact_rows=EXACT_ROWS):
+        sketch = cls(compression, exact_rows)
+        sketch.group = frame['group'].to_numpy(dtype=np.int64)
+        sketch.mean = frame['mean'].to_numpy(dtype=np.float64)
+        sketch.weight = frame['weight'].to_numpy(dtype=np.float64)
+        return sketch
+
+
+# Poisson bootstrap sums of weight and value x weight, shape (n_groups, replicates) each; additive across calls
+def bootstrap_sums(groups, n_groups, values, weights, replicates=REPLICATES, seed=0):
+    rng = np.random.default_rng(seed)
+    groups = np.asarray(groups, dtype=np.int64)
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    weights = np.nan_to_num(np.asarray(weights, dtype=np.float64))
+
+    sum_w = np.zeros((n_groups, replicates))
+    sum_xw = np.zeros((n_groups, replicates))
+    for start in range(0, len(groups), BOOTSTRAP_BATCH_ROWS):
+        batch = slice(start, start + BOOTSTRAP_BATCH_ROWS)
+        order, starts, batch_groups = weighted_agg.group_rows(groups[batch])
+        if len(starts) == 0:
+            continue
+        # Poisson(1) counts by inverting the CDF, one comparison per possible count
+        uniform = rng.random((len(order), replicates), dtype=np.float32)
+        counts = np.zeros(uniform.shape, dtype=np.uint8)
+        for p in POISSON_CDF[:-1]:
+            counts += uniform >= p
+        draws = counts * weights[batch][order, None]
+        sum_w[batch_groups] += np.add.reduceat(draws, starts, axis=0)
+        sum_xw[batch_groups] += np.add.reduceat(draws * values[batch][order, None], starts, axis=0)
+    return sum_w, sum_xw
+
+
+# Percentile interval of the bootstrap means of each group
+def bootstrap_interval(sum_w, sum_xw, level=0.95):
+    tail = (1 - level) / 2 * 100
+    # Groups without weight get no interval
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = sum_xw / sum_w
+        return np.nanpercentile(means, tail, axis=1), np.nanpercentile(means, 100 - tail, axis=1)
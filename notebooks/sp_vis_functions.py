@@ -1,118 +1,109 @@
 
 import pandas as pd
 import numpy as np
-from IPython.display import display, HTML
+from IPython.display import display, HTML, Image
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap, BoundaryNorm
 from matplotlib.patches import Patch
 from adjustText import adjust_text
+import geopandas as gpd
+import io
+import os
+from collections import OrderedDict
+
+# Files of the summary cube written by code/create_summary_file.py (see code/summary_cube.py)
+RANKINGS_FILE = 'rankings.csv'
+BIN_CUTOFFS_FILE = 'bin_cutoffs.csv'
+COUNTRIES_FILE = 'countries.gpkg'
+
+# Polygon layers of the cube: coarse for the World map, finer for a single region
+MAP_VIEWS = ['world', 'region']
+
+# Rendered maps kept in memory (least recently used are dropped first)
+MAP_CACHE_SIZE = 16
+
+def load_summary_cube(path='summary_data/summary_cube', crs='+proj=eqearth +datum=WGS84'):
+    # Rankings indexed by (region, year, d_type), bin cutoffs and polygons by key, so widgets only do lookups
+    rankings = pd.read_csv(os.path.join(path, RANKINGS_FILE)).set_index(['region', 'year', 'd_type']).sort_index()
+
+    bins = pd.read_csv(os.path.join(path, BIN_CUTOFFS_FILE)).sort_values('bin')
+    bin_cutoffs = {key: group['cutoff'].to_numpy()
+                   for key, group in bins.groupby(['region', 'year', 'd_type', 'variable', 'scheme'])}
+
+    countries = {view: gpd.read_file(os.path.join(path, COUNTRIES_FILE), layer=view).to_crs(crs) for view in MAP_VIEWS}
+    countries_by_region = {region: group for region, group in countries['region'].groupby('REGION_WB')}
+    countries_by_region['World'] = countries['world']
+
+    return {
+        'rankings': rankings,
+        'bin_cutoffs': bin_cutoffs,
+        'countries': countries_by_region,
+        'regions': ['World'] + sorted(countries_by_region.keys() - {'World'}),
+        'table_html': {},
+        'map_images': OrderedDict(),
+    }
 
-def update_tables(df, year, internet_type, region):
-    try:
-        plt.rcParams['font.family'] = 'Arial'
-        plt.rcParams['font.size'] = 14
-
-        palette = ListedColormap(["#a1d99b", "#74c476", "#31a354", "#006d2c", "#00441b"])
-
-        internet_type_map = {
-            'Mobile Internet': 'mobile',
-            'Fixed Internet': 'fixed'
-        }
-        internal_internet_type = internet_type_map[internet_type]  # Map display value to internal value
-
-        df2 = df.drop(columns=['geometry'])
-
-        df_year = df2[(df2['year'] == year) & 
-                     (df2['d_type'] == internal_internet_type) & 
-                     (df2['k_tests'] >= 1) &
-                     ((df2['REGION_WB'] == region) | (region == 'World'))].drop_duplicates(subset=['Country']).copy()
-
-        df_last = df2[(df2['year'] == year-1) & 
-                     (df2['d_type'] == internal_internet_type)  & 
-                     (df2['k_tests'] >= 1) &
-                     ((df2['REGION_WB'] == region) | (region == 'World'))].drop_duplicates(subset=['Country']).copy()
-
-        # Rank countries based on avg_d_mbps and avg_d_mbps_w for the selected year and previous year
-        df_year['rank_avg_d_mbps'] = df_year['avg_d_mbps'].rank(ascending=False)
-        df_year['rank_avg_d_mbps_w'] = df_year['avg_d_mbps_w'].rank(ascending=False)
-
-        df_last['rank_avg_d_mbps'] = df_last['avg_d_mbps'].rank(ascending=False)
-        df_last['rank_avg_d_mbps_w'] = df_last['avg_d_mbps_w'].rank(ascending=False)
-
-        # Merge data for selected year and previous year to calculate rank changes
-        df_merged = pd.merge(df_year[['Country', 'avg_d_mbps', 'avg_d_mbps_w', 'rank_avg_d_mbps', 'rank_avg_d_mbps_w']],
-                             df_last[['Country', 'rank_avg_d_mbps', 'rank_avg_d_mbps_w']],
-                             on='Country', how='left',
-                             suffixes=('', '_last'))
-
-        df_merged['rank_change_avg_d_mbps'] = (df_merged['rank_avg_d_mbps_last'] - df_merged['rank_avg_d_mbps']).fillna(0).astype(int)
-        df_merged['rank_change_avg_d_mbps_w'] = (df_merged['rank_avg_d_mbps_w_last'] - df_merged['rank_avg_d_mbps_w']).fillna(0).astype(int)
-
-        def format_rank_change(change):
-            if change > 0:
-                arrow = '▲'
-                color = 'green'
-            elif change < 0:
-                arrow = '▼'
-                color = 'red'
-            else:
-                arrow = '➖'  # Icon for no change
-                color = 'grey'
-            return f'<span style="color: {color};">{arrow} {abs(change) if change != 0 else ""}</span>'
-
-        df_merged['rank_change_avg_d_mbps'] = df_merged.apply(
-            lambda x: format_rank_change(x['rank_change_avg_d_mbps']), axis=1)
-
-        df_merged['rank_change_avg_d_mbps_w'] = df_merged.apply(
-            lambda x: format_rank_change(x['rank_change_avg_d_mbps_w']), axis=1)
-
-        df_sorted_speed = df_merged[['Country', 'avg_d_mbps', 'rank_avg_d_mbps', 'rank_change_avg_d_mbps']].sort_values(by='avg_d_mbps', ascending=False)
-        df_sorted_speed_w = df_merged[['Country', 'avg_d_mbps_w', 'rank_avg_d_mbps_w', 'rank_change_avg_d_mbps_w']].sort_values(by='avg_d_mbps_w', ascending=False)
-
-        df_sorted_speed['Color'] = get_color_palette(df_sorted_speed['avg_d_mbps'], palette)
-        df_sorted_speed = df_sorted_speed.rename(columns={'avg_d_mbps': 'Mbps', 'rank_avg_d_mbps': '#', 'rank_change_avg_d_mbps': 'Rank Change'})
-
-        df_sorted_speed_w['Color'] = get_color_palette(df_sorted_speed_w['avg_d_mbps_w'], palette)
-        df_sorted_speed_w = df_sorted_speed_w.rename(columns={'avg_d_mbps_w': 'Mbps', 'rank_avg_d_mbps_w': '#', 'rank_change_avg_d_mbps_w': 'Rank Change'})
-
-        max_speed = df_sorted_speed['Mbps'].max()
-        max_speed_w = df_sorted_speed_w['Mbps'].max()
-
-        html_speed = df_sorted_speed.to_html(index=False, columns=['#', 'Country', 'Mbps', 'Rank Change'],
-                                             header=[f'<b style="font-family: Arial; font-weight: bold; font-size: 14px; color: black;">{year} - {internet_type} Download Speed <i class="fa fa-download"></i></b>', 'Country', f'<b style="font-family: Arial; font-weight: bold; font-size: 14px; color: black;">Download Speed (Mbps)</b>', 'Rank Change'],
-                                             formatters={'#': '{:,.0f}'.format,
-                                                         'Country': lambda x: f'<div style="text-align: left; font-family: Arial; font-weight: bold;">{x}</div>',
-                                                         'Mbps': lambda x: f'<span style="color: {df_sorted_speed.loc[df_sorted_speed["Mbps"] == x, "Color"].values[0]}; font-weight: bold; font-size: 16px; font-family: Arial;">{x:.1f}</span><br>{create_bar(x, max_speed)}',
-                                                         'Rank Change': str},
-                                             escape=False,
-                                             table_id='speed_table')
-
-        html_speed_w = df_sorted_speed_w.to_html(index=False, columns=['#', 'Country', 'Mbps', 'Rank Change'],
-                                                 header=[f'<b style="font-family: Arial; font-weight: bold; font-size: 14px; color: black;">{year} - {internet_type} Download Speed Weighted <i class="fa fa-download"></i></b>', 'Country', f'<b style="font-family: Arial; font-weight: bold; font-size: 14px; color: black;">Download Speed Weighted by Population (Mbps)</b>', 'Rank Change'],
-                                                 formatters={'#': '{:,.0f}'.format,
-                                                             'Country': lambda x: f'<div style="text-align: left; font-family: Arial; font-weight: bold;">{x}</div>',
-                                                             'Mbps': lambda x: f'<span style="color: {df_sorted_speed_w.loc[df_sorted_speed_w["Mbps"] == x, "Color"].values[0]}; font-weight: bold; font-size: 16px; font-family: Arial;">{x:.1f}</span><br>{create_bar(x, max_speed_w)}',
-                                                             'Rank Change': str},
-                                                 escape=False,
-                                                 table_id='speed_table')
-
-        html_speed = f'''
+def cube_slice(cube, region, year, internal_internet_type):
+    # Ranked countries of one (region, year, type); empty when the slice has no data
+    key = (region, year, internal_internet_type)
+    if key not in cube['rankings'].index:
+        return cube['rankings'].iloc[:0].reset_index()
+    return cube['rankings'].loc[[key]].reset_index()
+
+def format_rank_changes(changes):
+    # Rank-change markup of a whole column: green up arrow, red down arrow or grey dash for no change
+    changes = np.asarray(changes, dtype=int)
+    arrows = np.select([changes > 0, changes < 0], ['▲', '▼'], '➖')
+    colors = np.select([changes > 0, changes < 0], ['green', 'red'], 'grey')
+    counts = np.where(changes != 0, np.abs(changes).astype(str), '')
+    return [f'<span style="color: {color};">{arrow} {count}</span>' for color, arrow, count in zip(colors, arrows, counts)]
+
+def speed_table_html(df_slice, variable, title, speed_label, palette):
+    # One ranking table; colours, bars and rank changes are computed column-wise, by row position
+    # Ties in speed keep the baseline's Country order (its rows came from an outer merge, sorted by Country)
+    df_sorted = df_slice.sort_values(by=[variable, 'Country'], ascending=[False, True], kind='stable')
+    speeds = df_sorted[variable]
+    max_speed = speeds.max()
+    colors = get_color_palette(speeds, palette)
+
+    table = pd.DataFrame({
+        '#': [f'{rank:,.0f}' for rank in df_sorted[f'rank_{variable}']],
+        'Country': [f'<div style="text-align: left; font-family: Arial; font-weight: bold;">{country}</div>' for country in df_sorted['Country']],
+        'Mbps': [f'<span style="color: {color}; font-weight: bold; font-size: 16px; font-family: Arial;">{speed:.1f}</span><br>{create_bar(speed, max_speed)}'
+                 for speed, color in zip(speeds, colors)],
+        'Rank Change': format_rank_changes(df_sorted[f'rank_change_{variable}']),
+    })
+
+    html = table.to_html(index=False,
+                         header=[f'<b style="font-family: Arial; font-weight: bold; font-size: 14px; color: black;">{title} <i class="fa fa-download"></i></b>', 'Country', f'<b style="font-family: Arial; font-weight: bold; font-size: 14px; color: black;">{speed_label}</b>', 'Rank Change'],
+                         escape=False,
+                         table_id='speed_table')
+
+    return f'''
             <style>
                 #speed_table th:nth-child(3) {{ width: 150px; }}
                 #speed_table td:nth-child(3) {{ width: 150px; }}
             </style>
-            {html_speed}
+            {html}
         '''
 
-        html_speed_w = f'''
-            <style>
-                #speed_table th:nth-child(3) {{ width: 150px; }}
-                #speed_table td:nth-child(3) {{ width: 150px; }}
-            </style>
-            {html_speed_w}
-        '''
+def tables_html(cube, year, internet_type, internal_internet_type, region):
+    # Rendered tables of one (year, type, region), cached in the cube
+    key = (year, internet_type, region)
+    if key in cube['table_html']:
+        return cube['table_html'][key]
+
+    palette = ListedColormap(["#a1d99b", "#74c476", "#31a354", "#006d2c", "#00441b"])
 
-        display(HTML(f'''
+    # Ranks and rank changes against the previous year are precomputed in the summary cube
+    df_slice = cube_slice(cube, region, year, internal_internet_type)
+
+    html_speed = speed_table_html(df_slice, 'avg_d_mbps', f'{year} - {internet_type} Download Speed',
+                                  'Download Speed (Mbps)', palette)
+    html_speed_w = speed_table_html(df_slice, 'avg_d_mbps_w', f'{year} - {internet_type} Download Speed Weighted',
+                                    'Download Speed Weighted by Population (Mbps)', palette)
+
+    html = f'''
             <div style="display: flex; flex-direction: column; gap: 20px;">
                 <h3 style="font-family: Arial; font-weight: bold; font-size: 16px; color: black;">{year} - {internet_type} Download Speed in {region}</h3>
                 <div style="display: flex; justify-content: space-between;">
@@ -126,7 +117,22 @@ def update_tables(df, year, internet_type, region):
                     </div>
                 </div>
             </div>
-        '''))
+        '''
+    cube['table_html'][key] = html
+    return html
+
+def update_tables(cube, year, internet_type, region):
+    try:
+        plt.rcParams['font.family'] = 'Arial'
+        plt.rcParams['font.size'] = 14
+
+        internet_type_map = {
+            'Mobile Internet': 'mobile',
+            'Fixed Internet': 'fixed'
+        }
+        internal_internet_type = internet_type_map[internet_type]  # Map display value to internal value
+
+        display(HTML(tables_html(cube, year, internet_type, internal_internet_type, region)))
 
         display(HTML('''
         <style>
@@ -152,7 +158,7 @@ def update_tables(df, year, internet_type, region):
         '''))
 
          # Update maps
-        update_map(df, year, internal_internet_type, region)
+        update_map(cube, year, internal_internet_type, region)
 
     except Exception as e:
         print(f"Error updating tables: {e}")
@@ -211,18 +217,24 @@ def plot_geodata(ax, gdf, variable, title, labels, num_bins=7, bin_cutoffs=None,
     #ax.set_title(title, fontsize=18, color='#404040', pad=10, loc='left')
     ax.set_axis_off()
 
-def update_map(data, year, internal_internet_type, region):
+def update_map(cube, year, internal_internet_type, region):
     plt.rcParams['font.family'] = 'DejaVu Serif'
     plt.rcParams['font.size'] = 12
     
     #title = f'{internet_type} Speed, {year} ({"Weighted by Population" if population == "Weighted" else "Not Weighted"})'
     
-    df_filtered = data[(data['year'] == year) & 
-                       (data['d_type'] == internal_internet_type) &
-                       ((data['REGION_WB'] == region) | (region == 'World'))].copy()
-
-    df_filtered.loc[df_filtered['k_tests'] < 1, 'avg_d_mbps'] = np.nan
-    df_filtered.loc[df_filtered['k_tests'] < 1, 'avg_d_mbps_w'] = np.nan
+    # Maps already drawn are shown from the LRU cache of rendered images
+    key = (year, internal_internet_type, region)
+    map_images = cube['map_images']
+    if key in map_images:
+        map_images.move_to_end(key)
+        display(map_images[key])
+        return
+
+    # Countries with less than 1k tests are not in the cube and are drawn as 'No data'
+    df_slice = cube_slice(cube, region, year, internal_internet_type)
+    df_filtered = cube['countries'][region].merge(df_slice[['Country', 'avg_d_mbps', 'avg_d_mbps_w']], on='Country', how='left')
+    bin_cutoffs = cube['bin_cutoffs']
  
     if region == 'World':
         fig, ax = plt.subplots(1, 2, figsize=(14, 8))
@@ -237,7 +249,7 @@ def update_map(data, year, internal_internet_type, region):
         title='',
         labels='Mbps',
         num_bins=10,
-        bin_cutoffs=get_bin_cutoffs(df_filtered, 'avg_d_mbps'),
+        bin_cutoffs=bin_cutoffs[(region, year, internal_internet_type, 'avg_d_mbps', 'deciles')],
         palette=["#f7fcf5", "#e5f5e0", "#c7e9c0", "#a1d99b", "#74c476", "#31a354", "#006d2c", "#005a29", "#00441b", "#00351d"],
         dec_pos_legend=0,
         leg_pos=3
@@ -251,24 +263,24 @@ def update_map(data, year, internal_internet_type, region):
         title='',
         labels='Mbps',
         num_bins=10,
-        bin_cutoffs=get_bin_cutoffs(df_filtered, 'avg_d_mbps_w'),
+        bin_cutoffs=bin_cutoffs[(region, year, internal_internet_type, 'avg_d_mbps_w', 'deciles')],
         palette=["#f7fcf5", "#e5f5e0", "#c7e9c0", "#a1d99b", "#74c476", "#31a354", "#006d2c", "#005a29", "#00441b", "#00351d"],
         dec_pos_legend=0,
         leg_pos=3
     )
     
     plt.tight_layout()
-    plt.show()
-
 
-def get_bin_cutoffs(df, variable, num_bins=10):
-    valid_data = df[variable].dropna()
-    bin_cutoffs = np.percentile(valid_data, np.linspace(0, 100, num_bins + 1))
-    bin_cutoffs = np.unique(bin_cutoffs) 
-    return bin_cutoffs
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    plt.close(fig)
+    map_images[key] = Image(data=buffer.getvalue())
+    while len(map_images) > MAP_CACHE_SIZE:
+        map_images.popitem(last=False)
+    display(map_images[key])
 
 
-def plot_scatter(df, year, internet_type, region):
+def plot_scatter(cube, year, internet_type, region):
     plt.rcParams['font.family'] = 'DejaVu Serif'
     plt.rcParams['font.size'] = 12
     
@@ -279,11 +291,7 @@ def plot_scatter(df, year, internet_type, region):
     
     internal_internet_type = internet_type_map[internet_type]
     
-    df_filtered = df[(df['year'] == year) & 
-                     (df['d_type'] == internal_internet_type) & 
-                     ((df['REGION_WB'] == region) | (region == 'World')) & 
-                     (df['k_tests'] >= 1)].copy()
-    df_filtered = df_filtered.drop_duplicates(subset='Country')
+    df_filtered = cube_slice(cube, region, year, internal_internet_type)
     
     x = df_filtered['avg_d_mbps']
     y = df_filtered['avg_d_mbps_w']
@@ -313,7 +321,7 @@ def plot_scatter(df, year, internet_type, region):
     plt.grid(True)
     plt.show()
     
-def plot_histogram(df, year, internet_type, region):
+def plot_histogram(cube, year, internet_type, region):
     plt.rcParams['font.family'] = 'DejaVu Serif'
     plt.rcParams['font.size'] = 12
     
@@ -324,11 +332,7 @@ def plot_histogram(df, year, internet_type, region):
     
     internal_internet_type = internet_type_map[internet_type]
     
-    df_filtered = df[(df['year'] == year) & 
-                     (df['d_type'] == internal_internet_type) & 
-                     ((df['REGION_WB'] == region) | (region == 'World')) & 
-                     (df['k_tests'] >= 1)].copy()
-    df_filtered = df_filtered.drop_duplicates(subset='Country')
+    df_filtered = cube_slice(cube, region, year, internal_internet_type)
     
     x = df_filtered['avg_d_mbps']
     y = df_filtered['avg_d_mbps_w']